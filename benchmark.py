@@ -0,0 +1,306 @@
+""" Benchmark the reconciliation service
+
+CSV files of made-up place names are generated for each size, then each storage is
+benchmarked against each file in its own process (so the peak memory use of one
+doesn't affect the others). Results are written as JSON, so they can be compared
+between versions:
+
+    python benchmark.py --sizes 10000,100000,1000000 --output benchmark.json
+"""
+
+from reconcile import *
+
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wsgiref.util
+
+# parts used to make up place names. Names are picked with a skewed distribution, so
+# like real names some are very common and most are rare
+SYLLABLES = ["ash", "bar", "bex", "brad", "brom", "bur", "car", "ches", "dar", "ded",
+    "dun", "el", "ex", "fal", "glen", "grims", "hal", "har", "hat", "ink", "ips", "kirk",
+    "lan", "lin", "mal", "mar", "mid", "new", "nor", "ox", "pen", "pres", "rich", "ros",
+    "sal", "shef", "stan", "stock", "sut", "tam", "thorn", "wal", "war", "wel", "wor", "york"]
+SUFFIXES = ["ton", "ham", "bury", "field", "ford", "wick", "by", "ley", "worth", "stead",
+    "mouth", "bridge", "chester", "well", "port", "dale", "minster", "land", "stow", "hurst"]
+PREFIXES = ["North", "South", "East", "West", "Upper", "Lower", "Great", "Little", "Old", "New"]
+RIVERS = ["on-Tees", "on-Trent", "upon Thames", "upon Tyne", "on-Sea", "le-Street", "in-Furness"]
+TYPES = ["Borough Council", "District Council", "City Council", "County Council", "Parish Council",
+    "Town Council", "District", "Borough"]
+
+def skewed(rnd, items, alpha=1.2):
+    """ Pick an item from a list, with the items at the start much more likely
+    """
+    return items[ int(rnd.paretovariate(alpha) - 1) % len(items) ]
+
+def make_name(rnd):
+    """ Make up a place name, like "Great Ashbury upon Tyne District Council"
+    """
+    name = skewed(rnd, SYLLABLES)
+    if rnd.random() < 0.3:
+        name += skewed(rnd, SYLLABLES)
+    name = (name + skewed(rnd, SUFFIXES)).capitalize()
+
+    words = [name]
+    if rnd.random() < 0.2:
+        words.insert(0, rnd.choice(PREFIXES))
+    if rnd.random() < 0.1:
+        words.append(rnd.choice(RIVERS))
+    if rnd.random() < 0.3:
+        words.append(skewed(rnd, TYPES))
+    return " ".join(words)
+
+def make_code(rnd):
+    """ Make up a postcode-like value for the `code` column
+    """
+    letters = "ABCDEFGHJKLMNPRSTUWYZ"
+    return "%s%s%d %d%s%s" % (rnd.choice(letters), rnd.choice(letters), rnd.randint(1, 99),
+        rnd.randint(1, 9), rnd.choice(letters), rnd.choice(letters))
+
+def generate_csv(csv_file, rows, seed=0):
+    """ Write a CSV file of made-up records, with id, name and code columns
+    """
+    rnd = random.Random(seed)
+    with open(csv_file, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "code"])
+        for n in xrange(rows):
+            writer.writerow(["R%08d" % n, make_name(rnd), make_code(rnd)])
+
+def make_queries(csv_file, count, seed=0):
+    """ Pick queries from the names in a CSV file. Some are used as they are, some are
+        changed in the ways real queries differ from the data (case, typos, missing words),
+        and some are new names which probably won't be found
+    """
+    rnd = random.Random(seed)
+
+    # pick `count` random rows from the file, without reading it all into memory
+    sample = []
+    for n, row in enumerate(get_from_csv(csv_file)):
+        if len(sample) < count:
+            sample.append(row)
+        else:
+            i = rnd.randint(0, n)
+            if i < count:
+                sample[i] = row
+
+    queries = []
+    ids = []
+    for row in sample:
+        name = row["name"]
+        kind = rnd.random()
+        if kind < 0.1:
+            name = name.upper()
+        elif kind < 0.3 and len(name) > 4:
+            i = rnd.randint(1, len(name) - 2)
+            name = name[:i] + name[i + 1:]
+        elif kind < 0.4 and " " in name:
+            name = name.rsplit(" ", 1)[0]
+        elif kind < 0.5:
+            name = make_name(rnd)
+        queries.append(name)
+        ids.append(row["id"])
+    return queries, ids
+
+def percentiles(timings):
+    """ Summarise a list of timings (in seconds) as milliseconds
+    """
+    timings = sorted(timings)
+    def p(n):
+        return round( timings[ min(len(timings) - 1, int(len(timings) * n / 100.0)) ] * 1000, 3 )
+    return {
+        "count": len(timings),
+        "mean_ms": round( sum(timings) / len(timings) * 1000, 3 ),
+        "p50_ms": p(50),
+        "p90_ms": p(90),
+        "p99_ms": p(99),
+        "max_ms": round( timings[-1] * 1000, 3 ),
+    }
+
+def wsgi_get(app, url):
+    """ Request a URL from a WSGI app without a server, reading the whole response.
+        Returns the status
+    """
+    path, _, query = url.partition("?")
+    environ = {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": "GET"}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    body = app(environ, start_response)
+    for chunk in body:
+        pass
+    if hasattr(body, "close"):
+        body.close()
+    return status[0]
+
+def run_case(case):
+    """ Benchmark one storage with one CSV file, returning a dict of results
+    """
+    storage = None
+    storage_options = {}
+    if case["storage"] == "whoosh":
+        storage = ReconcileStorageWhoosh
+    elif case["storage"] == "snapshot":
+        # the snapshot is kept next to the CSV file, so later runs time opening it
+        storage = ReconcileStorageSnapshot
+        storage_options["scorer"] = case["scorer"]
+        storage_options["snapshot_file"] = case["csv"] + ".snapshot"
+        storage_options["fingerprint"] = csv_fingerprint(case["csv"])
+    elif case["storage"] == "sqlite":
+        # like the snapshot, the database is kept next to the CSV file
+        storage = ReconcileStorageSQLite
+        storage_options["database"] = case["csv"] + ".sqlite"
+        storage_options["fingerprint"] = csv_fingerprint(case["csv"])
+    else:
+        storage_options["scorer"] = case["scorer"]
+
+    with open(case["queries_file"]) as f:
+        queries, ids = json.load(f)
+
+    result = dict(case)
+    del result["queries_file"]
+
+    # build the index. Caching is turned off so each query is actually run
+    start = time.time()
+    r = ReconcileEngine(
+        source = get_from_csv(case["csv"]),
+        storage = storage,
+        storage_options = storage_options,
+        limit = case["limit"],
+        cache_size = 0,
+        )
+    result["build_s"] = round( time.time() - start, 3 )
+    result["records"] = r.count()
+
+    with r:
+        # single queries
+        timings = []
+        for q in queries:
+            start = time.time()
+            r.query(q)
+            timings.append( time.time() - start )
+        result["query"] = percentiles(timings)
+
+        # batches of queries, as sent by OpenRefine
+        batch_size = case["batch_size"]
+        batches = [ queries[n:n + batch_size] for n in range(0, len(queries), batch_size) ]
+        timings = []
+        start = time.time()
+        for batch in batches:
+            batch_start = time.time()
+            r.queries( OrderedDict( ("q%s" % n, q) for n, q in enumerate(batch) ) )
+            timings.append( time.time() - batch_start )
+        elapsed = time.time() - start
+        result["queries"] = percentiles(timings)
+        result["queries"]["queries_per_s"] = round( len(queries) / elapsed, 1 ) if elapsed else None
+
+        # the endpoints, called through the bottle app
+        bottle.TEMPLATE_PATH.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "views"))
+        app = create_app(r)
+        rnd = random.Random(0)
+        pages = max(1, result["records"] // 100)
+        timings = []
+        for n in range(case["requests"]):
+            start = time.time()
+            wsgi_get(app, "/data?offset=%s&limit=100" % (rnd.randint(0, pages - 1) * 100))
+            timings.append( time.time() - start )
+        result["data"] = percentiles(timings)
+
+        timings = []
+        for id in ids[:case["requests"]]:
+            start = time.time()
+            wsgi_get(app, "/view/%s" % id)
+            timings.append( time.time() - start )
+        result["view"] = percentiles(timings)
+
+    # ru_maxrss is in kilobytes on linux (bytes on OS X)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    result["peak_rss_mb"] = round( maxrss / 1024.0 / 1024.0, 1 )
+    return result
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the reconciliation service with generated CSV files')
+    parser.add_argument('--sizes', default="10000,100000", help='Comma-separated numbers of rows to generate CSV files with (eg 10000,100000,1000000,5000000)')
+    parser.add_argument('--storage', default="dict,whoosh", help='Comma-separated storages to benchmark (dict, whoosh, snapshot or sqlite)')
+    parser.add_argument('--scorer', default="difflib", choices=["difflib", "numpy"], help='How candidates are scored (dict storage only)')
+    parser.add_argument('--queries', default=1000, type=int, help='Number of queries to run')
+    parser.add_argument('--batch-size', default=10, type=int, help='Number of queries in each batch')
+    parser.add_argument('--requests', default=200, type=int, help='Number of requests made to each endpoint')
+    parser.add_argument('-l', '--limit', default=10, type=int, help='Number of results returned for each query')
+    parser.add_argument('--data-dir', default=None, help='Directory to keep the generated CSV files in, so they can be reused')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for generating the CSV files and queries')
+    parser.add_argument('-o', '--output', default=None, help='File to write the results to (printed if not given)')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # run a single case, in a process started below
+    if args.case:
+        print json.dumps( run_case( json.loads(args.case) ) )
+        return
+
+    # the generated files are only kept if a directory to keep them in is given
+    if args.data_dir:
+        data_dir = args.data_dir
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+    else:
+        data_dir = tempfile.mkdtemp()
+
+    results = []
+    try:
+        for size in [ int(s) for s in args.sizes.split(",") ]:
+            csv_file = os.path.join(data_dir, "benchmark-%s-%s.csv" % (size, args.seed))
+            if not os.path.exists(csv_file):
+                start = time.time()
+                generate_csv(csv_file, size, args.seed)
+                print >> sys.stderr, "Generated %s rows in %.1fs" % (size, time.time() - start)
+
+            queries_file = os.path.join(data_dir, "benchmark-%s-%s-%s.json" % (size, args.seed, args.queries))
+            if not os.path.exists(queries_file):
+                with open(queries_file, "w") as f:
+                    json.dump( make_queries(csv_file, args.queries, args.seed), f )
+
+            for storage in args.storage.split(","):
+                case = {
+                    "rows": size,
+                    "storage": storage,
+                    "scorer": args.scorer,
+                    "csv": os.path.abspath(csv_file),
+                    "queries_file": os.path.abspath(queries_file),
+                    "batch_size": args.batch_size,
+                    "requests": args.requests,
+                    "limit": args.limit,
+                }
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)])
+                result = json.loads(output)
+                print >> sys.stderr, "%s rows, %s: built in %ss, query p50 %sms p99 %sms, %s queries/s, %sMB" % (
+                    size, storage, result["build_s"], result["query"]["p50_ms"], result["query"]["p99_ms"],
+                    result["queries"]["queries_per_s"], result["peak_rss_mb"])
+                results.append(result)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+
+if __name__ == '__main__':
+    main()
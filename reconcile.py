@@ -2,148 +2,628 @@ import bottle
 
 from reconcileEngine import *
 from reconcileStorageWhoosh import *
+from reconcileStorageSnapshot import *
+from reconcileStorageSQLite import *
+from reconcileServer import *
+from reconcileMetrics import *
+from reconcileBatcher import *
 
 import json
 import argparse
 import csv
+import itertools
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
 from collections import OrderedDict
 
 def get_from_csv(csv_file, header_row=True, delimiter=","):
-    """ Turn a CSV file into a list of dicts/lists
+    """ Read a CSV file one row at a time, yielding ReconcileRecords which share
+        the field names from the header row. Without a header row the fields are
+        named by their column position ("0", "1", ...)
     """
-
-    source = []
     
     with open(csv_file, 'r') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        
+        fields = None
         if(header_row):
-            reader = csv.DictReader(f, delimiter=delimiter)
-        else:
-            reader = csv.reader(f, delimiter=delimiter)
+            fields = record_fields( next(reader, []) )
             
         for row in reader:
-            source.append(row)
+            # skip blank lines, like csv.DictReader
+            if not row:
+                continue
+            if fields is None:
+                fields = record_fields( str(n) for n in range(len(row)) )
+            yield ReconcileRecord(fields, row)
+    
+def get_page():
+    """ Get the offset and limit used to paginate records from the request
+    """
+    try:
+        offset = max(0, int(bottle.request.query.offset or 0))
+        limit = bottle.request.query.limit or None
+        if limit is not None:
+            limit = max(1, int(limit))
+    except ValueError:
+        bottle.abort(400, "offset and limit must be integers")
+    return offset, limit
+    
+def jsonp(data):
+    """ Return data as JSON, wrapped in the callback function if the request has a
+        `callback` parameter (JSONP)
+    """
+    with metrics.timer("stage_seconds", stage="serialise"):
+        body = json.dumps(data)
+    callback = bottle.request.query.callback
+    if callback:
+        bottle.response.content_type = "application/javascript"
+        return "%s(%s)" % (callback, body)
+    bottle.response.content_type = "application/json"
+    return body
+    
+def record_dict(i):
+    """ Turn a record into a dict which can be serialised as JSON
+    """
+    if isinstance(i, ReconcileRecord):
+        return i.to_dict()
+    return i
+    
+def stream_json(records, ndjson=False, chunk_size=1000):
+    """ Serialise records as a JSON array (or newline-delimited JSON), yielding
+        `chunk_size` records at a time so the whole response is never held in memory
+    """
+    separator = "\n" if ndjson else ",\n"
+    if not ndjson:
+        yield "["
+    
+    chunk = []
+    first = True
+    for i in records:
+        chunk.append( json.dumps(record_dict(i)) )
+        if len(chunk) >= chunk_size:
+            yield ("" if first else separator) + separator.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield ("" if first else separator) + separator.join(chunk)
+        first = False
+        
+    if ndjson:
+        if not first:
+            yield "\n"
+    else:
+        yield "]"
+    
+def csv_fingerprint(csv_file, header_row=True, delimiter=","):
+    """ Identify the version of a CSV file by its size and modification time, along 
+        with the options used to read it
+    """
+    stat = os.stat(csv_file)
+    return "%s:%s:%s:%s" % (stat.st_size, stat.st_mtime, header_row, delimiter)
+            
+def normalise_options(args):
+    """ Get the options for normalising names from the command line arguments, or None 
+        if they are all the defaults
+    """
+    options = {}
+    if args.reorder:
+        options["reorder"] = True
+    if args.rembrackets:
+        options["rembrackets"] = True
+    if args.stopwords:
+        options["stopwords"] = ReconcileNormaliser.default_stopwords if args.stopwords == "default" else args.stopwords.split(",")
+    if args.legal_suffixes:
+        options["suffixes"] = ReconcileNormaliser.legal_suffixes if args.legal_suffixes == "default" else args.legal_suffixes.split(",")
+    return options or None
+    
+def reload_csv(r, args):
+    """ Reload the CSV file into the engine in the background, returning the thread 
+        doing the reload
+    """
+    source = get_from_csv( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    storage_options = {}
+    if args.storage in ("whoosh", "sqlite") or args.snapshot:
+        storage_options["fingerprint"] = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    return r.reload(source, close_delay = args.reload_grace, **storage_options)
+    
+def watch_csv(r, args):
+    """ Check the CSV file for changes every `args.watch` seconds, in a background thread.
+        The file is reloaded once it has changed and then stayed the same for a check, 
+        so it isn't read while it's still being written
+    """
+    def watch():
+        loaded = last = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+        while True:
+            time.sleep(args.watch)
+            try:
+                fingerprint = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+            except OSError:
+                # the file is being replaced
+                continue
+            if fingerprint != loaded and fingerprint == last:
+                loaded = fingerprint
+                reload_csv(r, args).join()
+            last = fingerprint
+    
+    t = threading.Thread(target=watch)
+    t.daemon = True
+    t.start()
+    return t
     
-    return source         
+def create_app(r, id_field="id", name="CSV Reconciliation Service", profile_dir=None, profile_min_time=0, batcher=None):
+    """ Create the bottle app serving the reconciliation service for an engine
+    
+    If `profile_dir` is set then requests taking at least `profile_min_time` seconds 
+    are profiled, and their stats saved in that directory. If a ReconcileBatcher is
+    given then single queries are run in batches with any others made at the same time
+    """
+    app = bottle.Bottle()
+    app.install( ReconcileRequestMetrics(metrics) )
+    if profile_dir:
+        app.install( ReconcileProfiler(profile_dir, profile_min_time) )
+    
+    @app.get('/')
+    @app.post('/')
+    def index():
+        """ Index of the server. If ?query or ?queries used then search,
+            otherwise return the default response as JSON
+        """
+        
+        query = bottle.request.params.query or None
+        
+        # try fetching the query as json data or a string
+        if query:
+            try:
+                query = json.loads(query)
+            except ValueError:
+                query = query
+            try:
+                if batcher is not None:
+                    return jsonp(batcher.query(query))
+                return jsonp(r.query(query))
+            except ReconcileBatchTimeout as e:
+                bottle.abort(503, str(e))
+            except ValueError as e:
+                bottle.abort(400, str(e))
             
-def main():
+        queries = bottle.request.params.queries or None
+        
+        if queries:
+            try:
+                queries = json.loads(queries, object_pairs_hook=OrderedDict)
+                return jsonp(r.queries(queries))
+            except ValueError as e:
+                bottle.abort(400, str(e))
+            
+        # return the service specification, using a callback if there is one
+        return jsonp(r.service_spec())
+    
+    @app.route('/view/<id>')
+    def view(id):
+        """ a view of a particular item - should be an HTML page
+        """
+        result = r.view( id )
+        if result is None:
+            bottle.abort(404, "No record with id '%s'" % id)
+        return bottle.template('result.html', 
+            result=result,
+            id_field=id_field
+            )
+    
+    @app.route('/suggest')
+    def suggest():
+        """ suggest API - records whose names start with `prefix`
+        """
+        prefix = bottle.request.query.prefix or None
+        if(prefix):
+            try:
+                limit = int(bottle.request.query.limit or 0) or None
+            except ValueError:
+                bottle.abort(400, "limit must be an integer")
+            return jsonp(r.suggest({"prefix":prefix, "limit":limit}))
+    
+    @app.route('/flyout')
+    def flyout():
+        """ flyout for the suggest API - a short HTML description of a record
+        """
+        id = bottle.request.query.id or None
+        result = r.flyout( id ) if id else None
+        if result is None:
+            bottle.abort(404, "No record with id '%s'" % id)
+        return jsonp(result)
+    
+    @app.route('/data.html')
+    @app.route('/all.html')
+    def data_html():
+        """ return a page of records, 100 at a time unless `limit` is set
+        """
+        offset, limit = get_page()
+        if limit is None:
+            limit = 100
+        docs = list(r.all(offset, limit))
+        headers = docs[0].keys() if docs else []
+        
+        return bottle.template('results.html', 
+            result=docs,
+            id_field=id_field,
+            headings= headers,
+            page_title=name,
+            offset=offset,
+            limit=limit,
+            total=r.count(),
+            )
+    
+    @app.route('/data')
+    @app.route('/all')
+    @app.route('/data.ndjson')
+    def data():
+        """ return all records, or a page of them if `offset` or `limit` are set
+        
+        The records are streamed as a JSON array, or newline-delimited JSON if
+        `format=ndjson` or the URL ends in .ndjson. If there are more records after 
+        the page a link to the next page is put in the Link header
+        """
+        offset, limit = get_page()
+        total = r.count()
+        bottle.response.set_header("X-Total-Count", str(total))
+        if limit is not None and offset + limit < total:
+            bottle.response.set_header("Link", '<%s?offset=%s&limit=%s>; rel="next"' % (
+                bottle.request.path, offset + limit, limit))
+        
+        ndjson = bottle.request.path.endswith(".ndjson") or bottle.request.query.format == "ndjson"
+        if ndjson:
+            bottle.response.content_type = "application/x-ndjson"
+        else:
+            bottle.response.content_type = "application/json"
+        return stream_json(r.all(offset, limit), ndjson=ndjson)
+    
+    @app.route('/stats')
+    def stats():
+        """ counters for the service
+        """
+        return {
+            "records": r.count(),
+            "cache": r.cache_stats(),
+        }
+    
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """ metrics for the service in the Prometheus text format
+        """
+        cache = r.cache_stats()
+        metrics.set("records", r.count())
+        metrics.set("cache_hits_total", cache["hits"])
+        metrics.set("cache_misses_total", cache["misses"])
+        bottle.response.content_type = "text/plain; version=0.0.4"
+        return metrics.prometheus()
+    
+    @app.route('/static/<filename:path>')
+    def send_static(filename):
+        """ if we need static files
+        """
+        return bottle.static_file(filename, root='./static')
 
-    parser = argparse.ArgumentParser(description='Run a reconciliation service based on a CSV file')
+    return app
+    
+def add_data_arguments(parser):
+    """ Add the arguments for the CSV file being reconciled against to a parser
+    """
     parser.add_argument('csv', help='path to a CSV file which will be reconciled against')
     parser.add_argument('-d', '--delimiter', default=",", help='Delimiter for the CSV file')
     parser.add_argument('--no-header-row', action='store_false', dest="header_row", help='CSV file does not have a header row')
+    parser.add_argument('-id', '--id_field', default="id", help='ID field in the CSV file')
+    parser.add_argument('-s', '--search_field', default="name", help='Field in the CSV file which will be used')
+    parser.set_defaults(header_row=True)
+    
+def add_storage_arguments(parser):
+    """ Add the arguments choosing and setting up the storage to a parser
+    """
+    parser.add_argument('--storage', default="dict", help='Which type of storage to use (dict, whoosh or sqlite)')
+    parser.add_argument('--scorer', default="difflib", choices=["difflib", "numpy"], help='How candidates are scored (dict storage only)')
+    parser.add_argument('--reorder', action='store_true', help='Sort the words of names into alphabetical order before matching them (dict and sqlite storages only)')
+    parser.add_argument('--rembrackets', action='store_true', help='Remove any words in brackets from names (dict and sqlite storages only)')
+    parser.add_argument('--stopwords', default=None, help='Comma-separated words to remove from names, or "default" for %s (dict and sqlite storages only)' % ",".join(ReconcileNormaliser.default_stopwords))
+    parser.add_argument('--legal-suffixes', default=None, help='Comma-separated words to remove from the end of names, or "default" for a list of company suffixes like ltd and plc (dict and sqlite storages only)')
+    parser.add_argument('--property-fields', default=None, help='Comma-separated fields to index for matching query properties - properties of other fields are ignored (dict storage only)')
+    parser.add_argument('--snapshot', default=None, help='Snapshot file to keep the data and indexes in between runs, which is read with mmap (dict storage only)')
+    parser.add_argument('--index-dir', default=None, help='Directory to keep the index in between runs (whoosh storage only)')
+    parser.add_argument('--index-procs', default=1, type=int, help='Number of processes used to build the index (whoosh storage only)')
+    parser.add_argument('--index-memory', default=128, type=int, help='MB of memory used by each process building the index (whoosh storage only)')
+    parser.add_argument('--multisegment', action='store_true', help='Don\'t merge the index built by each process, which is quicker to build but slower to search (whoosh storage only)')
+    parser.add_argument('--store-keys', action='store_true', help='Also index the normalised names, so names which normalise to the same as the query are ranked first (whoosh storage only)')
+    parser.add_argument('--database', default=None, help='SQLite database file to keep the data and index in between runs (sqlite storage only)')
+    
+def add_engine_arguments(parser, workers=1, executor="thread"):
+    """ Add the arguments for running and caching queries to a parser
+    """
+    parser.add_argument('-w', '--workers', default=workers, type=int, help='Number of workers used to run a batch of queries')
+    parser.add_argument('--executor', default=executor, choices=["thread", "process"], help='Run batches of queries in a thread pool or a process pool')
+    parser.add_argument('--cache-size', default=10000, type=int, help='Number of query results to cache (0 to turn off the cache)')
+    parser.add_argument('--cache-ttl', default=None, type=int, help='Number of seconds to cache query results for')
+    parser.add_argument('--cache-memory', default=None, type=int, help='Maximum size of the query result cache in MB')
+    
+def get_storage(args):
+    """ Return the storage class and storage options chosen by the arguments
+    """
+    storage = None
+    storage_options = {}
+    if(args.storage=="dict"):
+        storage_options["scorer"] = args.scorer
+        storage_options["normalise_options"] = normalise_options(args)
+        if args.property_fields:
+            storage_options["property_fields"] = args.property_fields.split(",")
+        if args.snapshot:
+            storage = ReconcileStorageSnapshot
+            storage_options["snapshot_file"] = args.snapshot
+            storage_options["fingerprint"] = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    elif(args.storage=="whoosh"):
+        storage = ReconcileStorageWhoosh
+        storage_options["procs"] = args.index_procs
+        storage_options["limitmb"] = args.index_memory
+        storage_options["multisegment"] = args.multisegment
+        storage_options["store_keys"] = args.store_keys
+        if args.index_dir:
+            storage_options["index_dir"] = args.index_dir
+            storage_options["fingerprint"] = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    elif(args.storage=="sqlite"):
+        storage = ReconcileStorageSQLite
+        storage_options["normalise_options"] = normalise_options(args)
+        if args.database:
+            storage_options["database"] = args.database
+            storage_options["fingerprint"] = csv_fingerprint( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    return storage, storage_options
+    
+def get_engine(args, **engine_options):
+    """ Load the CSV file into a ReconcileEngine set up by the arguments. Any other 
+        options for the engine can be given as keyword arguments
+    """
+    # stream the data from the CSV file into the storage
+    source = get_from_csv( args.csv, header_row = args.header_row, delimiter = args.delimiter )
+    storage, storage_options = get_storage(args)
+    return ReconcileEngine(source=source, 
+        id_field=args.id_field, 
+        search_field=args.search_field, 
+        storage = storage,
+        workers = args.workers,
+        executor = args.executor,
+        storage_options = storage_options,
+        cache_size = args.cache_size,
+        cache_ttl = args.cache_ttl,
+        cache_memory = args.cache_memory * 1024 * 1024 if args.cache_memory else None,
+        **engine_options
+        )
+    
+def column_position(header, column):
+    """ Find the position of a column in a CSV file, given its name in the header row or
+        its position
+    """
+    if header is not None and column in header:
+        return header.index(column)
+    try:
+        return int(column)
+    except ValueError:
+        raise ValueError("Column '%s' isn't in the input file" % column)
+    
+def csv_value(v):
+    """ Turn a value from the results into a byte string that can be written to a CSV file
+    """
+    if isinstance(v, unicode):
+        return v.encode("utf-8")
+    return v
+    
+def bulk_reconcile(r, input_file, output, column, top=1, properties=None, chunk_size=1000, header_row=True, delimiter=",", progress=None):
+    """ Reconcile a column of a CSV file, writing each row to `output` (a file object) as 
+        CSV, followed by the id, name, score and whether it's an exact match for each of 
+        its best `top` matches
+    
+    The rows are read, reconciled and written `chunk_size` at a time, so only one chunk
+    is held in memory however big the file is. Each chunk is run as a batch of queries, 
+    which the engine's workers share. `properties` is a list of (column, field) pairs: 
+    the value of the column is used as a property of the query for that field. 
+    `progress` is called with the number of rows written after each chunk. Returns the 
+    number of rows
+    """
+    match_fields = []
+    for n in range(1, top + 1):
+        suffix = "" if n == 1 else "_%d" % n
+        match_fields += [ f + suffix for f in ("match_id", "match_name", "match_score", "match_exact") ]
+    
+    with open(input_file, 'r') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        writer = csv.writer(output, delimiter=delimiter)
+        header = next(reader, []) if header_row else None
+        column = column_position(header, column)
+        properties = [ (column_position(header, c), field) for c, field in properties or [] ]
+        if header is not None:
+            writer.writerow(header + match_fields)
+        
+        # short rows (like blank lines) are padded so the match fields line up
+        if header is not None:
+            width = len(header)
+        else:
+            width = max( [column] + [ c for c, field in properties ] ) + 1
+        
+        rows = 0
+        while True:
+            chunk = list( itertools.islice(reader, chunk_size) )
+            if not chunk:
+                break
+            
+            # rows without a name aren't reconciled
+            queries = OrderedDict()
+            for n, row in enumerate(chunk):
+                name = row[column] if column < len(row) else ""
+                if not name.strip():
+                    continue
+                q = {"query": name, "limit": top}
+                q_properties = [ {"pid": field, "v": row[c]} for c, field in properties if c < len(row) and row[c] ]
+                if q_properties:
+                    q["properties"] = q_properties
+                queries["q%d" % n] = q
+            results = r.queries(queries) if queries else {}
+            
+            for n, row in enumerate(chunk):
+                values = list(row) + [ "" ] * (width - len(row))
+                matches = results["q%d" % n]["result"][0:top] if "q%d" % n in results else []
+                for m in matches:
+                    values += [ csv_value(m["id"]), csv_value(m["name"]), m["score"], "true" if m["match"] else "false" ]
+                values += [ "" ] * (len(match_fields) - 4 * len(matches))
+                writer.writerow(values)
+            output.flush()
+            
+            rows += len(chunk)
+            if progress is not None:
+                progress(rows)
+    return rows
+    
+def bulk_main(argv=None):
+    """ Reconcile a column of a CSV file against another CSV file, without running the
+        service: `python reconcile.py bulk REFERENCE.csv INPUT.csv -o OUTPUT.csv`
+    """
+    parser = argparse.ArgumentParser(prog='reconcile.py bulk', description='Reconcile a column of a CSV file against another CSV file, writing the best matches for each row to a new CSV file')
+    add_data_arguments(parser)
+    parser.add_argument('input', help='path to a CSV file with a column of names to reconcile')
+    parser.add_argument('-o', '--output', default="-", help='CSV file to write the rows of the input file and their matches to (default is standard output)')
+    parser.add_argument('-c', '--column', default=None, help='Column of the input file with the names to reconcile, by name or position (defaults to the search field)')
+    parser.add_argument('--properties', default=None, help='Comma-separated columns of the input file to use as properties of the queries, as COLUMN or COLUMN:FIELD if the field has a different name')
+    parser.add_argument('--input-delimiter', default=None, help='Delimiter for the input file (defaults to the delimiter of the CSV file)')
+    parser.add_argument('--top', default=1, type=int, help='Number of matches written for each row')
+    parser.add_argument('--chunk-size', default=1000, type=int, help='Number of rows read and reconciled at a time')
+    add_storage_arguments(parser)
+    add_engine_arguments(parser, workers=multiprocessing.cpu_count(), executor="process")
+    parser.add_argument('--quiet', action='store_true', help='Don\'t report progress')
+    args = parser.parse_args(argv)
+    
+    properties = []
+    for p in (args.properties or "").split(","):
+        if p:
+            column, _, field = p.partition(":")
+            properties.append( (column, field or column) )
+    
+    # only the property fields are indexed, so add the fields the properties use
+    property_fields = (args.property_fields or "").split(",") + [ field for column, field in properties ]
+    args.property_fields = ",".join( f for f in OrderedDict.fromkeys(property_fields) if f )
+    
+    start = time.time()
+    def progress(rows):
+        elapsed = time.time() - start
+        sys.stderr.write("\r%d rows reconciled (%.0f rows/s)" % (rows, rows / elapsed if elapsed else 0))
+        sys.stderr.flush()
+    
+    with get_engine(args) as r:
+        if not args.quiet:
+            sys.stderr.write("Loaded %d records in %.1fs\n" % (r.count(), time.time() - start))
+            start = time.time()
+        output = sys.stdout if args.output == "-" else open(args.output, 'wb')
+        try:
+            rows = bulk_reconcile(r, args.input, output, 
+                column = args.column if args.column is not None else args.search_field,
+                top = args.top,
+                properties = properties,
+                chunk_size = args.chunk_size,
+                header_row = args.header_row,
+                delimiter = args.input_delimiter or args.delimiter,
+                progress = None if args.quiet else progress,
+                )
+        except ValueError as e:
+            parser.error(str(e))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    if not args.quiet:
+        sys.stderr.write("\n")
+    return rows
+    
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == "bulk":
+        bulk_main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(description='Run a reconciliation service based on a CSV file, or reconcile a whole CSV file against it with `reconcile.py bulk`')
+    add_data_arguments(parser)
     parser.add_argument('-host', '--host', default="localhost", help='host for the service')
     parser.add_argument('-p', '--port', default=8080, help='port for the service')
-    parser.add_argument('-id', '--id_field', default="id", help='ID field in the CSV file')
     parser.add_argument('-t', '--type', default="/item", help='Type of object returned by the reconciliation service')
-    parser.add_argument('-s', '--search_field', default="name", help='Field in the CSV file which will be used')
-    parser.add_argument('--storage', default="dict", help='Which type of storage to use')
+    add_storage_arguments(parser)
+    parser.add_argument('-l', '--limit', default=10, type=int, help='Number of results returned for a query that does not set a limit')
+    add_engine_arguments(parser)
+    parser.add_argument('--server', default="wsgiref", choices=SERVERS, help='Web server used to run the service')
+    parser.add_argument('--threads', default=None, type=int, help='Number of threads used by the server to handle requests')
+    parser.add_argument('--server-workers', default=None, type=int, help='Number of processes forked by the server to handle requests (gunicorn only)')
+    parser.add_argument('--backlog', default=None, type=int, help='Number of connections waiting to be accepted by the server')
+    parser.add_argument('--queue-size', default=None, type=int, help='Number of accepted connections waiting for a thread')
+    parser.add_argument('--keep-alive', default=None, type=int, help='Seconds to keep an idle connection open for')
+    parser.add_argument('--watch', default=None, type=float, help='Check the CSV file for changes every this many seconds, and reload it when it changes')
+    parser.add_argument('--reload-grace', default=30, type=float, help='Seconds to keep the old data for after reloading, so queries using it can finish')
+    parser.add_argument('--batch-window', default=0, type=float, help='Milliseconds to wait for single queries made at the same time to run them as a batch (0 to run each query on its own)')
+    parser.add_argument('--batch-max', default=100, type=int, help='Largest number of single queries run as a batch')
+    parser.add_argument('--batch-timeout', default=30, type=float, help='Seconds a query run in a batch waits for its results before giving up')
+    parser.add_argument('--profile-dir', default=None, help='Directory to save cProfile stats for each request in')
+    parser.add_argument('--profile-min-ms', default=0, type=float, help='Only save the stats for requests taking at least this many milliseconds')
     parser.add_argument('--debug', action='store_true', dest="debug", help='Debug mode (autoreloads the server)')
     parser.add_argument('--name', default="CSV Reconciliation Service", help='Name of the reconciliation service')
-    parser.set_defaults(header_row=True, debug=False)
+    parser.set_defaults(debug=False)
+
+    args = parser.parse_args(argv)
+    
+    # gunicorn's master process handles SIGHUP itself, and its workers are forked from
+    # the master, so they would never see the data reloaded by the master
+    if args.server == "gunicorn" and args.watch:
+        parser.error("--watch can't be used with the gunicorn server")
 
-    args = parser.parse_args()
+    # with a server handling one request at a time there's nothing to batch a query with,
+    # so it would only be held up by the window
+    if args.batch_window > 0 and not is_threaded_server(args.server, args.threads):
+        parser.error("--batch-window needs a server which handles requests at the same time, like --server threaded")
 
     # URL that will host the reconciliation service
     service_url = "http://" + args.host + ":" + str(args.port) + "/"
     if args.debug: 
         print "Reconciliation service starting on:", service_url
     
-    # get the data from the CSV file
-    source = get_from_csv( args.csv, header_row = args.header_row, delimiter = args.delimiter )
-    
-    storage = None
-    if(args.storage=="whoosh"):
-        storage = ReconcileStorageWhoosh
-    
     # Start the reconciliation engine and the bottle service
-    with ReconcileEngine(source=source, 
-        id_field=args.id_field, 
-        search_field=args.search_field, 
+    with get_engine(args, 
         service_url = service_url,
-        storage = storage,
         name = args.name,
+        limit = args.limit,
         ) as r:
         
-        @bottle.get('/')
-        @bottle.post('/')
-        def index():
-            """ Index of the server. If ?query or ?queries used then search,
-                otherwise return the default response as JSON
-            """
-            
-            query = bottle.request.params.query or None
-            
-            # try fetching the query as json data or a string
-            if query:
-                try:
-                    query = json.loads(query)
-                except ValueError:
-                    query = query
-                return r.query(query)
-                
-            queries = bottle.request.params.queries or None
-            
-            if queries:
-                queries = json.loads(queries, object_pairs_hook=OrderedDict)
-                return r.queries(queries)
-                
-            # if we're doing a callback request then do that
-            if(bottle.request.query.callback):
-                bottle.response.content_type = "application/javascript"
-                return "%s(%s)" % (bottle.request.query.callback, r.service_spec())
-                
-            # otherwise just return the service specification
-            return r.service_spec()
+        # reload the CSV file when it changes, or when the process is sent SIGHUP
+        if args.watch:
+            watch_csv(r, args)
+        if hasattr(signal, "SIGHUP") and args.server != "gunicorn":
+            signal.signal(signal.SIGHUP, lambda signum, frame: reload_csv(r, args))
         
-        @bottle.route('/view/<id>')
-        def view(id):
-            """ a view of a particular item - should be an HTML page
-            """
-            return bottle.template('result.html', 
-                result=r.view( id ),
-                id_field=args.id_field
-                )
+        # run single queries made at the same time in batches
+        batcher = None
+        if args.batch_window > 0:
+            batcher = ReconcileBatcher(r, window = args.batch_window / 1000.0, max_size = args.batch_max, timeout = args.batch_timeout)
         
-        @bottle.route('/suggest')
-        def suggest():
-            """ suggest API, not sure if this works
-            """
-            prefix = bottle.request.query.prefix or None
-            if(prefix):
-                return r.suggest({"prefix":prefix})
+        app = create_app(r, 
+            id_field = args.id_field, 
+            name = args.name, 
+            profile_dir = args.profile_dir, 
+            profile_min_time = args.profile_min_ms / 1000.0,
+            batcher = batcher,
+            )
         
-        @bottle.route('/data.html')
-        @bottle.route('/all.html')
-        def data():
-            """ return all records
-                @todo paginate for long records
-            """
-            docs = r.source
-            headers = r.source[0].keys()
-            
-            return bottle.template('results.html', 
-                result=docs,
-                id_field=args.id_field,
-                headings= headers,
-                page_title=args.name
-                )
-        
-        @bottle.route('/data')
-        @bottle.route('/all')
-        def data():
-            """ return all records
-                @todo paginate for long records
-            """
-            bottle.response.content_type = "application/json"
-            return json.dumps(r.source)
-        
-        @bottle.route('/static/<filename:path>')
-        def send_static(filename):
-            """ if we need static files
-            """
-            return bottle.static_file(filename, root='./static')
-
-        bottle.run(host=args.host, port=args.port, reloader=args.debug)        
+        # the index has been built, so any server processes forked from here will share it
+        server, server_options = get_server(args.server, 
+            threads = args.threads,
+            workers = args.server_workers,
+            backlog = args.backlog,
+            keep_alive = args.keep_alive,
+            queue_size = args.queue_size,
+            )
+        bottle.run(app, host=args.host, port=args.port, reloader=args.debug, server=server, **server_options)        
         
 
 if __name__ == '__main__':
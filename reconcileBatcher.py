@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class ReconcileBatcher:
+    """ Collects single queries made at the same time (by the threads of a threaded
+        server) into batches, which are run together by the engine
+
+    The first query to arrive waits up to `window` seconds for others to join it, then
+    the batch (of up to `max_size` queries) is run with `engine.queries` - so the queries
+    share the cache lookups and are scored together - and each thread gets its own
+    results back. While a batch is running new queries queue up for the next one, so
+    under load batches grow without waiting longer.
+
+    A query which hasn't been answered after `timeout` seconds (like when the batches
+    are held up by a slow query) raises a ReconcileBatchTimeout rather than waiting for ever.
+    """
+
+    def __init__(self, engine, window=0.005, max_size=100, timeout=30):
+        self.engine = engine
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        # the process the thread running the batches was started in
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        """ Start the thread running the batches, if it isn't running in this process.
+            The thread is started by the first query, as a server may fork processes 
+            to handle requests (like gunicorn's workers) which wouldn't have it
+        """
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid != os.getpid():
+                # anything queued in the parent process belongs to the parent
+                self.pending = []
+                self.condition = threading.Condition()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def query(self, q):
+        """ Add a query to the next batch, and wait for its results
+        """
+        self.start()
+        item = ReconcileBatchItem(q)
+        with self.condition:
+            if self.closed:
+                raise ValueError("The batcher has been closed")
+            self.pending.append(item)
+            self.condition.notify()
+        if not item.done.wait(self.timeout):
+            with self.condition:
+                # don't run the query if it's still waiting for a batch
+                if item in self.pending:
+                    self.pending.remove(item)
+            raise ReconcileBatchTimeout("The query wasn't answered within %s seconds" % self.timeout)
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def next_batch(self):
+        """ Wait for queries to arrive, and return the next batch of them. Returns None
+            once the batcher has been closed
+        """
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+
+            # give other queries until the end of the window to join the first one
+            deadline = time.time() + self.window
+            while len(self.pending) < self.max_size and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.pending[0:self.max_size]
+            del self.pending[0:self.max_size]
+            return batch
+
+    def run(self):
+        """ Run batches of queries until the batcher is closed
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                # the queries come from different clients, so one bad query mustn't fail
+                # the others - run them one at a time so each only gets its own error
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    for item in batch:
+                        try:
+                            self.run_batch([item])
+                        except Exception as e:
+                            item.error = e
+            finally:
+                for item in batch:
+                    item.done.set()
+
+    def run_batch(self, batch):
+        """ Run a batch of queries with the engine, and give each item its result
+        """
+        results = self.engine.queries( OrderedDict( ("q%s" % n, item.q) for n, item in enumerate(batch) ) )
+        for n, item in enumerate(batch):
+            item.result = results["q%s" % n]
+
+    def close(self):
+        """ Stop running batches. Queries which are waiting are given an error
+        """
+        with self.condition:
+            self.closed = True
+            pending = self.pending
+            self.pending = []
+            self.condition.notify_all()
+        for item in pending:
+            item.error = ValueError("The batcher has been closed")
+            item.done.set()
+
+class ReconcileBatchTimeout(Exception):
+    """ Raised when a query run in a batch isn't answered in time
+    """
+    pass
+
+class ReconcileBatchItem:
+    """ A query waiting to be run as part of a batch
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
@@ -0,0 +1,117 @@
+import threading
+import time
+
+# positions of the fields in each link of the cache's linked list
+PREV, NEXT, KEY, VALUE, EXPIRES, SIZE = 0, 1, 2, 3, 4, 5
+
+class ReconcileCache:
+    """ A least-recently-used cache holding up to `max_size` items
+
+    Items can also be given a time to live of `ttl` seconds, and the cache limited to
+    `max_bytes`, where the size of each item is worked out using the `sizeof` function.
+
+    Safe to share between threads. Counts the hits, misses and evictions so the cache
+    can be monitored.
+
+    Items are held in a dict of key => link in a circular doubly linked list, with
+    the most recently used item at the end of the list, so getting and setting
+    items are both O(1)
+    """
+
+    def __init__(self, max_size=1024, ttl=None, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def get(self, key, default=None):
+        """ Return the value for a key, or default if it isn't in the cache
+        """
+        with self.lock:
+            link = self.links.get(key)
+            if link is not None and link[EXPIRES] is not None and link[EXPIRES] < time.time():
+                self._remove(link)
+                self.evictions += 1
+                link = None
+
+            if link is None:
+                self.misses += 1
+                return default
+
+            # move the item to the end of the list, as it's now the most recently used
+            self._unlink(link)
+            self._append(link)
+            self.hits += 1
+            return link[VALUE]
+
+    def set(self, key, value):
+        """ Add an item to the cache, removing the least recently used items if
+            the cache is full
+        """
+        if self.max_size <= 0:
+            return
+
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+        size = 0
+        if self.max_bytes:
+            size = self.sizeof(value)
+
+        with self.lock:
+            link = self.links.get(key)
+            if link is not None:
+                self._remove(link)
+
+            link = [None, None, key, value, expires, size]
+            self._append(link)
+            self.links[key] = link
+            self.bytes += size
+
+            while len(self.links) > self.max_size or (self.max_bytes and self.bytes > self.max_bytes):
+                self._remove(self.root[NEXT])
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove everything from the cache
+        """
+        with self.lock:
+            self.links = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None, None, 0]
+            self.bytes = 0
+
+    def stats(self):
+        """ Return the counters for the cache
+        """
+        return {
+            "size": len(self.links),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self.links[link[KEY]]
+        self.bytes -= link[SIZE]
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        last = self.root[PREV]
+        link[PREV] = last
+        link[NEXT] = self.root
+        last[NEXT] = link
+        self.root[PREV] = link
+
+    def __len__(self):
+        return len(self.links)
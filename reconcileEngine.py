@@ -1,4 +1,40 @@
 from reconcileStorageDict import *
+from reconcileCache import *
+from reconcileMetrics import *
+
+import cgi
+import heapq
+import json
+import multiprocessing
+import multiprocessing.pool
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+# engine used by the worker processes of a process pool. This is set just before the 
+# pool is created, so the forked workers share the parent's index copy-on-write
+_worker_engine = None
+
+def _worker_init():
+    """ Set up a worker process of a process pool. Threads of the parent process (like 
+        the server's) may have been holding locks when it was forked, which would never 
+        be released in the worker, so the worker replaces them with new ones
+    """
+    metrics.lock = threading.Lock()
+    _worker_engine.storage.after_fork()
+
+def _worker_queries(qs):
+    """ Run a chunk of queries in a worker process
+    """
+    return _worker_engine.run_queries(qs)
+
+def _text(v):
+    """ Return a value as unicode - values read from a CSV file are UTF-8 byte strings
+    """
+    if isinstance(v, str):
+        return v.decode("utf-8", "replace")
+    return unicode(v or "")
 
 class ReconcileEngine:
     """Main engine for powering the reconciliation
@@ -6,11 +42,24 @@ class ReconcileEngine:
     Wraps around the search itself and controls the dict that is returned (and the server then
     converts into a JSON response)
     
-    Search storage can be specified with the `storage` parameter
+    Search storage can be specified with the `storage` parameter, and any extra options
+    for the storage passed as a dict in `storage_options`
+    
+    Batches of queries can be run in parallel by setting `workers` to more than 1. 
+    `executor` is either "thread" or "process" - threads share everything but are
+    limited by the GIL, processes are forked once the index is built
+    
+    The results of up to `cache_size` queries are cached (0 turns the cache off). Cached
+    results can also be expired after `cache_ttl` seconds, and the cache limited to 
+    roughly `cache_memory` bytes
+    
+    The source can be reloaded while the engine is in use, with `reload`. The new storage 
+    is built in the background and swapped in once it's ready
     """
 
-    def __init__(self, source=None, id_field="id", search_field="name", type="match", service_url="http://localhost:8000/", storage=None, name="CSV Reconciliation Service"):
-        """Initiate the ReconcileEngine. source is a list of dictionaries/lists
+    def __init__(self, source=None, id_field="id", search_field="name", type="match", service_url="http://localhost:8000/", storage=None, name="CSV Reconciliation Service", limit=10, workers=1, executor="thread", storage_options=None, cache_size=10000, cache_ttl=None, cache_memory=None):
+        """Initiate the ReconcileEngine. source is an iterable of dictionaries or
+        ReconcileRecords, which is only read once by the storage
         """
         default_storage = ReconcileStorageDict
         if storage is None:
@@ -26,14 +75,91 @@ class ReconcileEngine:
         self.url = service_url
         # the name of the reconciliation
         self.name = name
+        # the number of results returned if a query doesn't set a limit
+        self.limit = limit
+        # how batches of queries are run in parallel
+        self.workers = workers
+        self.executor = executor
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # cache of query results. The generation is part of each cache key, and changes
+        # whenever the storage does, so results from an old storage are never used
+        self.cache = ReconcileCache(cache_size, ttl=cache_ttl, max_bytes=cache_memory, sizeof=lambda r: len(json.dumps(r)))
+        self.generation = 0
             
         # setup the storage
-        self.storage = storage(source, search_field, id_field)
+        self.storage_class = storage
+        self.storage_options = storage_options or {}
+        self.storage = None
+        self.load_lock = threading.Lock()
+        self.load(source)
+        
+    def load(self, source, close_delay=0, **storage_options):
+        """Build the storage from a source, replacing any existing storage
+        
+        The new storage is built from the old one, so only rows which have changed need 
+        indexing again. Queries carry on using the old storage until the new one is ready. 
+        Any cached results and worker processes using the old storage are then thrown away,
+        and the old storage is closed after `close_delay` seconds, so that queries which 
+        are still using it can finish. `storage_options` override the engine's options
+        """
+        options = dict(self.storage_options)
+        options.update(storage_options)
+        
+        with self.load_lock:
+            old_storage = self.storage
+            with metrics.timer("stage_seconds", stage="load"):
+                storage = self.storage_class(source, self.search_field, self.id_field, previous=old_storage, **options)
+            
+            self.storage = storage
+            self.generation += 1
+            self.cache.clear()
+            
+            # start the workers for the new storage straight away - the first load is 
+            # before the server has started any threads which could be holding locks 
+            # when the workers are forked
+            with self.pool_lock:
+                old_pool = self.pool
+                self.pool = self.start_pool() if self.workers > 1 else None
+            metrics.set("records", storage.count())
+            
+        if old_storage is not None:
+            if close_delay:
+                threading.Timer(close_delay, self.retire, (old_storage, old_pool)).start()
+            else:
+                self.retire(old_storage, old_pool)
+        
+    def reload(self, source, close_delay=30, **storage_options):
+        """Load a source in a background thread, returning the thread. If loading fails 
+        the error is printed and the engine carries on using the existing storage
+        """
+        def run():
+            try:
+                self.load(source, close_delay, **storage_options)
+                metrics.inc("reloads_total")
+            except Exception:
+                metrics.inc("reload_errors_total")
+                traceback.print_exc(file=sys.stderr)
+                
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
+        
+    def retire(self, storage, pool=None):
+        """Close a storage that has been replaced, once the worker pool that was using it 
+        has finished any queries it was given
+        """
+        if pool is not None:
+            pool.close()
+            pool.join()
+        storage.close()
         
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close_pool()
         self.storage.close()
         
     def service_spec(self):
@@ -69,43 +195,129 @@ class ReconcileEngine:
         }
         
     def suggest(self, q):
-        """Use the suggest API
+        """Use the suggest API, returning records whose names start with `q["prefix"]`
         
-        Currently doesn't work
+        Uses the storage's prefix index rather than running a full query, so it's quick
+        enough to use while the user is typing
         """
     
         prefix = q["prefix"]
-        q["query"] = q["prefix"] + "*"
-        q = self.query(q)
+        limit = q.get("limit") or self.limit
+        
+        result = []
+        for i in self.storage.prefix_search(prefix, limit):
+            result.append({
+                "id":i[self.id_field],
+                "name":i[self.search_field],
+                "type":[{
+                    "id": "/" + self.type,
+                    "name": self.type
+                }],
+                "score":i.score,
+            })
         
         return {
             "code": "/api/status/ok",
             "status": "200 OK",
             "prefix": prefix,
-            "result": q["result"],
+            "result": result,
+        }
+        
+    def flyout(self, id):
+        """Return a short HTML description of a record for the suggest flyout, or None
+        if there isn't a record with that id
+        """
+        record = self.get_by_id(id)
+        if record is None:
+            return None
+        
+        html = ['<div class="fbs-flyout-content">']
+        html.append( '<h3>%s</h3>' % cgi.escape(_text(record[self.search_field])) )
+        for k in record:
+            if k != self.search_field:
+                html.append( '<p><strong>%s:</strong> %s</p>' % (cgi.escape(_text(k)), cgi.escape(_text(record[k]))) )
+        html.append('</div>')
+        
+        return {
+            "id": id,
+            "html": "".join(html),
         }
         
     def query(self, q):
         """Fetch a user query from the storage and return in the correct format
+        
+        Uses the cached results if the same query has been run before
+        """
+        metrics.inc("queries_total")
+        with metrics.timer("query_seconds"):
+            q = self.make_query(q)
+            key = self.cache_key(q)
+            results = self.cache.get(key)
+            if results is None:
+                results = self.run_query(q)
+                self.cache.set(key, results)
+            return results
+        
+    def make_query(self, q):
+        """Create a ReconcileQuery from a user query, using the default limit
         """
-    
-        # create a query and get the results from the storage engine
         q = ReconcileQuery(q)
-        results = self.storage.search(q)
+        if not q.limit:
+            q.limit = self.limit
+        return q
+        
+    def cache_key(self, q):
+        """The key for the results of a query in the cache. Queries that the storage 
+        treats as the same (eg with the same normalised name) share a key
+        """
+        return (
+            self.generation,
+            self.storage.cache_key(q.query),
+            q.limit,
+            json.dumps(q.type, sort_keys=True),
+            json.dumps(q.type_strict, sort_keys=True),
+            json.dumps(q.properties, sort_keys=True),
+        )
+        
+    def cache_stats(self):
+        """Return the hit/miss counters and size of the result cache
+        """
+        return self.cache.stats()
         
-        # sort the results by score
-        if getattr(results, "sort", None):
-            results.sort(key=lambda x: x.score, reverse=True)
+    def run_query(self, q):
+        """Get the results of a ReconcileQuery from the storage and return in the correct format
+        """
+        return self.format_results(q, self.storage.search(q))
+        
+    def run_queries(self, qs):
+        """Get the results of a list of ReconcileQuery objects from the storage, which can
+        search for them all at once, and return a list of results in the correct format
+        """
+        return [ self.format_results(q, hits) for q, hits in zip(qs, self.storage.search_many(qs)) ]
+        
+    def format_results(self, q, results):
+        """Turn the hits found by the storage for a query into the results returned
+        """
         
-        # if there's a limit on results only return those results
-        if q.limit:
-            results = results[0:q.limit]
+        # if there's a limit on results only keep the best results, otherwise sort them all by score
+        with metrics.timer("stage_seconds", stage="sort"):
+            if q.limit:
+                results = heapq.nlargest(q.limit, results, key=lambda x: x.score)
+            else:
+                results = sorted(results, key=lambda x: x.score, reverse=True)
             
         # prepare each result in the JSON return format
+        matched = False
         for i in results:
             
             # check if it's an exact match
-            match = q.query.lower()==i[self.search_field].lower() or i.score==100
+            match = _text(q.query).lower()==_text(i[self.search_field]).lower() or i.score==100
+            
+            # if we've got an exact match then just return it, along with any other 
+            # records with the same name
+            if matched and not match:
+                break
+            matched = matched or match
         
             q.add_result({
                 "id":i[self.id_field],
@@ -117,37 +329,116 @@ class ReconcileEngine:
                 "score":i.score,
                 "match":match,
             })
-            
-            # if we've got an exact match then just return it
-            if match:
-                return q.results
         
         return q.results
         
     def queries(self, qs):
         """Allow multiple queries to be returned
+        
+        Results are returned in the same order as the queries
+        """
+        
+        with metrics.timer("batch_seconds"):
+            qs = ReconcileQueries(qs)
+            keys = list(qs.queries.keys())
+            metrics.inc("batches_total")
+            metrics.inc("queries_total", len(keys))
+            metrics.observe("batch_size", len(keys))
+            
+            # use cached results where there are any, and run each of the other queries once
+            queries = dict( (k, self.make_query(qs.queries[k])) for k in keys )
+            cache_keys = dict( (k, self.cache_key(queries[k])) for k in keys )
+            results = {}
+            missing = OrderedDict()
+            for k in keys:
+                if cache_keys[k] in results or cache_keys[k] in missing:
+                    continue
+                result = self.cache.get( cache_keys[k] )
+                if result is None:
+                    missing[cache_keys[k]] = queries[k]
+                else:
+                    results[cache_keys[k]] = result
+            for key, result in zip(missing.keys(), self.map_queries(list(missing.values()))):
+                results[key] = result
+                self.cache.set( key, result )
+            
+            for k in keys:
+                qs.add_result(k, results[cache_keys[k]])
+            return qs.results
+        
+    def map_queries(self, queries):
+        """Run a list of ReconcileQuery objects, using the worker pool if there is one, 
+        and return a list of results in the same order
+        """
+        if self.workers <= 1 or len(queries) <= 1:
+            return self.run_queries(queries)
+        
+        # each worker runs a chunk of the queries at a time
+        pool = self.get_pool()
+        chunksize = max(1, len(queries) // (self.workers * 4))
+        chunks = [ queries[n:n + chunksize] for n in range(0, len(queries), chunksize) ]
+        if self.executor == "process":
+            results = pool.map(_worker_queries, chunks)
+        else:
+            results = pool.map(self.run_queries, chunks)
+        return [ r for chunk in results for r in chunk ]
+        
+    def get_pool(self):
+        """Return the worker pool, starting it again if it has been closed
         """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = self.start_pool()
+            return self.pool
+        
+    def start_pool(self):
+        """Start a new worker pool for the current storage
+        """
+        global _worker_engine
+        
+        if self.executor == "process":
+            _worker_engine = self
+            return multiprocessing.Pool(self.workers, initializer=_worker_init)
+        elif self.executor == "thread":
+            return multiprocessing.pool.ThreadPool(self.workers)
+        raise ValueError("Unknown executor '%s'" % self.executor)
         
-        qs = ReconcileQueries(qs)
-        for k,q in qs.queries.iteritems():
-            qs.add_result(k, self.query(q))
-        return qs.results
+    def close_pool(self):
+        """Stop the worker pool, if there is one
+        """
+        with self.pool_lock:
+            pool = self.pool
+            self.pool = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        
+    def get_by_id(self, id):
+        """Return the record with a particular id, or None if there isn't one
+        """
+        return self.storage.get_by_id(id)
+        
+    def all(self, offset=0, limit=None):
+        """Return an iterator over the records, starting at `offset` and returning 
+        up to `limit` records
+        """
+        return self.storage.all(offset, limit)
+        
+    def count(self):
+        """Return the number of records
+        """
+        return self.storage.count()
         
     def view(self, id):
         """ Not yet implemented - should return a nice HTML view of the result
         """
-        return getattr(self, id)
+        return self.get_by_id(id)
         
     def __getattr__(self, name):
         if(name=="source" or name=="data"):
-            return self.storage.all()
+            return self.all()
     
-        results = self.storage.__getattr__(name)
-        
-        if(len(results)>0):
-            return results
-        else:
-            raise AttributeError("ReconcileEngine instance has no attribute '%s'" % name)
+        raise AttributeError("ReconcileEngine instance has no attribute '%s'" % name)
 
 class ReconcileQuery:
     """
@@ -168,6 +459,8 @@ class ReconcileQuery:
         # if the query is a string then construct an object
         if( isinstance( q, basestring ) ):
             q = {"query":q}
+        if not isinstance(q, dict):
+            raise ValueError("A query must be a string or an object")
             
         # get the values, using defaults if needed
         for a in defaults:
@@ -175,10 +468,41 @@ class ReconcileQuery:
                 setattr(self, a, q[a])
             else:
                 setattr(self, a, defaults[a])
+        
+        if not isinstance(self.properties or [], list) or not all( isinstance(p, dict) for p in self.properties or [] ):
+            raise ValueError("The properties of a query must be a list of objects")
                 
         # initialise the results array
         self.results = {"result":[]}
         
+    def property_values(self):
+        """ Return the properties of the query as a list of (property, [values]) tuples
+        
+        Properties are given as {"pid": "postcode", "v": "SW1A 1AA"}. The value can 
+        be a list, and each value a string, number or an {"id":...} dict
+        """
+        properties = []
+        for p in self.properties or []:
+            pid = p.get("pid") or p.get("p")
+            v = p.get("v")
+            if pid is None or v is None:
+                continue
+            if not isinstance(v, list):
+                v = [v]
+                
+            values = []
+            for i in v:
+                if isinstance(i, dict):
+                    i = i.get("id") or i.get("name")
+                if i is None:
+                    continue
+                if not isinstance(i, basestring):
+                    i = unicode(i)
+                values.append(i)
+            if values:
+                properties.append( (pid, values) )
+        return properties
+        
     def add_result(self, r):
         """ Add a result to the list of results
         """
@@ -192,7 +516,7 @@ class ReconcileQueries:
     """
 
     def __init__(self,qs):
-        self.results = {}
+        self.results = OrderedDict()
         self.queries = qs
     
     def add_result(self, k, q):
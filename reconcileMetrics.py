@@ -0,0 +1,199 @@
+import cProfile
+import itertools
+import os
+import re
+import threading
+import time
+
+class ReconcileMetrics:
+    """ Counters, gauges and histograms for monitoring the service, which can be output
+        in the Prometheus text format
+
+    Each metric can have labels, given as keyword arguments, eg
+    `metrics.inc("requests_total", route="/")`. Metrics are only kept for the process
+    that records them, so queries run in a process pool aren't counted.
+    """
+
+    # default histogram buckets, for timings in seconds
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix="reconcile_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.types = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+
+    def describe(self, name, help, type="counter", buckets=None):
+        """ Set the help text and type of a metric (and the buckets of a histogram)
+        """
+        self.help[name] = help
+        self.types[name] = type
+        if buckets is not None:
+            self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        """ Add to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "counter")
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set the value of a gauge
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "gauge")
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        """ Add a value (like a timing) to a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "histogram")
+            buckets = self.buckets.get(name, self.default_buckets)
+            h = self.values.get(key)
+            if h is None:
+                # the count in each bucket, followed by the sum and the total count
+                h = self.values[key] = [0] * (len(buckets) + 2)
+            for n, b in enumerate(buckets):
+                if value <= b:
+                    h[n] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def timer(self, name, **labels):
+        """ Return a context manager which adds the time taken by its block to a histogram
+        """
+        return ReconcileTimer(self, name, labels)
+
+    def clear(self):
+        """ Reset all the metrics
+        """
+        with self.lock:
+            self.values = {}
+
+    def prometheus(self):
+        """ Return the metrics in the Prometheus text format
+        """
+        with self.lock:
+            values = sorted( (k, list(v) if isinstance(v, list) else v) for k, v in self.values.items() )
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            full_name = self.prefix + name
+            type = self.types.get(name, "untyped")
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (full_name, self.help[name]))
+                lines.append("# TYPE %s %s" % (full_name, type))
+
+            if type == "histogram":
+                total = 0
+                for b, count in zip(self.buckets.get(name, self.default_buckets), value):
+                    total += count
+                    lines.append("%s_bucket%s %s" % (full_name, format_labels(labels + (("le", b),)), total))
+                lines.append("%s_bucket%s %s" % (full_name, format_labels(labels + (("le", "+Inf"),)), value[-1]))
+                lines.append("%s_sum%s %s" % (full_name, format_labels(labels), repr(float(value[-2]))))
+                lines.append("%s_count%s %s" % (full_name, format_labels(labels), value[-1]))
+            else:
+                lines.append("%s%s %s" % (full_name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    """ Format labels as {name="value",...} for the Prometheus text format
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join( '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels )
+
+class ReconcileTimer:
+    """ Times a block of code, adding the time taken to a histogram
+
+        with metrics.timer("stage_seconds", stage="score"):
+            ...
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.start
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+
+class ReconcileRequestMetrics:
+    """ bottle plugin counting the requests to each route, and timing them
+    """
+    name = "reconcile_request_metrics"
+    api = 2
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def apply(self, callback, route):
+        rule = route.rule
+        def wrapper(*args, **kwargs):
+            self.metrics.inc("requests_total", route=rule)
+            with self.metrics.timer("request_seconds", route=rule):
+                return callback(*args, **kwargs)
+        return wrapper
+
+class ReconcileProfiler:
+    """ bottle plugin which profiles each request with cProfile, saving the stats for
+        requests taking at least `min_time` seconds to `profile_dir`
+
+    The stats can be read with the pstats module, eg `python -m pstats FILE`
+    """
+    name = "reconcile_profiler"
+    api = 2
+
+    def __init__(self, profile_dir, min_time=0):
+        self.profile_dir = profile_dir
+        self.min_time = min_time
+        self.counter = itertools.count(1)
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    def apply(self, callback, route):
+        rule = re.sub(r"[^A-Za-z0-9]+", "-", route.rule).strip("-") or "index"
+        def wrapper(*args, **kwargs):
+            profiler = cProfile.Profile()
+            start = time.time()
+            try:
+                return profiler.runcall(callback, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                if elapsed >= self.min_time:
+                    filename = "%s-%s-%s-%dms.prof" % (time.strftime("%Y%m%d%H%M%S"), next(self.counter), rule, elapsed * 1000)
+                    profiler.dump_stats( os.path.join(self.profile_dir, filename) )
+        return wrapper
+
+# metrics recorded by the service
+metrics = ReconcileMetrics()
+metrics.describe("queries_total", "Number of queries run, including cached queries")
+metrics.describe("batches_total", "Number of batches of queries run")
+metrics.describe("query_seconds", "Time taken to answer a single query", type="histogram")
+metrics.describe("batch_seconds", "Time taken to answer a batch of queries", type="histogram")
+metrics.describe("batch_size", "Number of queries in each batch", type="histogram", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+metrics.describe("stage_seconds", "Time spent in each stage of loading data and answering queries", type="histogram")
+metrics.describe("candidates", "Number of candidate names scored for each query", type="histogram", buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+metrics.describe("requests_total", "Number of requests to each route")
+metrics.describe("request_seconds", "Time taken to handle requests to each route", type="histogram")
+metrics.describe("records", "Number of records", type="gauge")
+metrics.describe("reloads_total", "Number of times the source has been reloaded")
+metrics.describe("reload_errors_total", "Number of times reloading the source has failed")
+metrics.describe("cache_hits_total", "Number of queries answered from the result cache")
+metrics.describe("cache_misses_total", "Number of queries which weren't in the result cache")
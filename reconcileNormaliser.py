@@ -0,0 +1,150 @@
+from reconcileCache import *
+
+import itertools
+import re
+import string
+
+class ReconcileNormaliser:
+    """ Produce normalised strings, to remove the influence of lower/upper-case etc on matching
+
+    The options are set once when the normaliser is created, so everything that can be
+    worked out in advance (regular expressions, the characters to remove, the list of words)
+    is only done once rather than for every string. Queries are usually repeated, so their
+    normalised form is kept in a cache.
+    """
+
+    default_options = {
+        "reorder": False,       # if true then the words in the string are reordered into alphabetical order
+        "remspaces": False,     # if true then all spaces between words are removed.
+        "rembrackets": False,   # if true then any words within brackets are removed.
+        "replacewords": True,   # if true then particular words are removed from the string.
+
+        # an array of the words that will be removed from the string. Values in the array can either be a string, in which case the word will be removed from anywhere in str, or an array with attributes "name" (the word) and "type" (beginning|middle|end) specifying where the word will be removed.
+        "words":[
+            {"name":"the",      "type":"beginning"},
+            {"name":"the",      "type":"end"},
+        ],
+        
+        "stopwords": [],        # words which are removed wherever they appear as a whole word
+        "suffixes": [],         # words which are removed from the end of the string, like the legal suffixes of company names
+    }
+    
+    # lists which can be used for the stopwords and suffixes options
+    default_stopwords = ["and", "of", "the"]
+    legal_suffixes = ["ltd", "limited", "plc", "llp", "llc", "lp", "inc", "incorporated", "corp", 
+        "corporation", "co", "company", "cic", "gmbh", "ag", "sa", "sarl", "bv", "nv", "pty"]
+
+    # characters which are kept in the normalised string - everything else is removed
+    keep_chars = string.ascii_lowercase + string.digits + " "
+
+    def __init__(self, options=None, cache_size=10000):
+
+        # set default options where no option is set
+        self.options = dict(self.default_options)
+        if options:
+            self.options.update(options)
+
+        self.brackets = re.compile(r'\([^)]*\)')       # regex expression for brackets
+        self.delete_chars = "".join( c for c in map(chr, range(256)) if c not in self.keep_chars )
+        self.value_delete_chars = self.delete_chars + " "
+
+        # the words to replace, as a list of (type, word) tuples
+        self.words = []
+        if( self.options["replacewords"] ):
+            for w in self.options["words"]:
+                if( isinstance(w, basestring) ):
+                    w = {"type":"middle", "name":w}
+                self.words.append( (w["type"], w["name"]) )
+                
+        # the stopwords and suffixes, normalised in the same way as the words of a string
+        self.stopwords = set( self.normalise_word(w) for w in self.options["stopwords"] )
+        self.suffixes = set( self.normalise_word(w) for w in self.options["suffixes"] )
+
+        self.cache = ReconcileCache(cache_size)
+
+    def normalise(self, str, partial=False):
+        """ Produce a normalised string from a given string
+        
+        If `partial` is true the string is the start of a name (like a prefix that is 
+        being typed), so words and suffixes aren't removed from the end of it
+        """
+
+        str = str.lower()                           # make the string lowercase
+        str = str.replace("&"," and ")              # replace any ampersands with " and "
+
+        # if we've chosen to remove brackets
+        if(self.options["rembrackets"]):
+            str = self.brackets.sub("", str)        # replace any text in the brackets
+
+        # remove any apostrophes and other non-alphanumeric characters. Anything outside
+        # ascii would be removed, so unicode strings can be converted to ascii first
+        if( isinstance(str, unicode) ):
+            str = str.encode("ascii", "ignore")
+        str = str.translate(None, self.delete_chars)
+
+        # for each word, remove it from end, beginning or middle as specified
+        for type, name in self.words:
+            if( type=="end" ):
+                if( str.endswith( name ) and not partial ):
+                    str = str[:-len( name )]
+            elif( type=="middle" ):
+                str = str.replace( name," ")
+            else:
+                if( str.startswith( name ) ):
+                    str = str[len( name ):]
+
+        str_array = str.split()                     # split into words, removing any extra spaces
+        
+        # remove any stopwords
+        if( self.stopwords ):
+            str_array = [ w for w in str_array if w not in self.stopwords ]
+            
+        # remove suffixes from the end, as long as there's a word left
+        if( self.suffixes and not partial ):
+            while len(str_array) > 1 and str_array[-1] in self.suffixes:
+                str_array.pop()
+
+        # if we're reordering the string
+        if( self.options["reorder"] ):
+            str_array = sorted(str_array)           # sort the array alphabetically
+
+        # remove all spaces from the string
+        if( self.options["remspaces"]):
+            return "".join(str_array)
+
+        return " ".join(str_array)                  # put the words back together again
+
+    def normalise_word(self, word):
+        """ Normalise a single word, like a stopword, keeping only its letters and numbers
+        """
+        word = word.lower()
+        if( isinstance(word, unicode) ):
+            word = word.encode("ascii", "ignore")
+        return word.translate(None, self.value_delete_chars)
+        
+    def normalise_value(self, value):
+        """ Normalise the value of a property so it can be looked up exactly, keeping
+            only the letters and numbers in lower case (eg "SW1A 1AA" => "sw1a1aa")
+        """
+        if( not isinstance(value, basestring) ):
+            value = str(value)
+        value = value.lower()
+        if( isinstance(value, unicode) ):
+            value = value.encode("ascii", "ignore")
+        return value.translate(None, self.value_delete_chars)
+
+    def normalise_query(self, str):
+        """ Normalise a query string, using the cached version if this query has been seen before
+        """
+        key = str
+        str = self.cache.get(key)
+        if str is None:
+            str = self.normalise(key)
+            self.cache.set(key, str)
+        return str
+
+    def normalise_many(self, strings):
+        """ Normalise each of an iterable of strings (for example when indexing), returning
+            an iterator of the normalised strings
+        """
+        return itertools.imap(self.normalise, strings)
@@ -0,0 +1,208 @@
+import difflib
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ReconcileScorer:
+    """ Scores candidate keys against a query string, on a scale of 0-100
+
+    The default scorer uses the ratio from difflib.SequenceMatcher
+    """
+
+    def __init__(self, keys=()):
+        pass
+
+    def top_scores(self, query_string, keys, limit=None):
+        """ Score each key against the query string, returning a list of (score, key)
+            tuples for the best `limit` keys, highest score first
+
+        The SequenceMatcher ratio can never be more than 2 * shorter / (combined length),
+        so keys are scored in order of that upper bound and scoring stops once the
+        bound can't beat the worst of the `limit` hits that are being kept
+        """
+
+        def bound(key):
+            total = len(query_string) + len(key)
+            if total == 0:
+                return 100.0
+            return 200.0 * min(len(query_string), len(key)) / total
+
+        heap = []
+        for i in sorted(keys, key=bound, reverse=True):
+            if limit and len(heap) >= limit and bound(i) <= heap[0][0]:
+                break
+            score = difflib.SequenceMatcher(None, query_string, i)
+            score = (score.ratio() * 100)
+            if not limit or len(heap) < limit:
+                heapq.heappush( heap, (score, i) )
+            elif score > heap[0][0]:
+                heapq.heapreplace( heap, (score, i) )
+
+        return sorted(heap, reverse=True)
+
+    def top_scores_many(self, query_strings, keys, limits):
+        """ Score a batch of queries, each against its own list of candidate keys and
+            with its own limit. Returns a list of top_scores results
+        """
+        return [ self.top_scores(q, k, l) for q, k, l in zip(query_strings, keys, limits) ]
+
+class ReconcileScorerNumpy(ReconcileScorer):
+    """ Scores keys using numpy, by the character trigrams they share with the query,
+        on the same scale as the SequenceMatcher ratio (2 * matching characters / 
+        combined length)
+
+    A run of n characters found in both the query and a key shares n - 2 trigrams, so
+    the matching characters are estimated as the shared trigrams + 2, up to the length
+    of the shorter string. For a key containing the query - the candidates found by the
+    dict storage - this gives exactly the SequenceMatcher ratio. Queries too short to
+    have a trigram inside them are checked for being in the key instead.
+
+    The trigrams of every key are turned into integer ids and packed into one contiguous
+    array, with the keys' offsets into it held in a second array. The candidates for a
+    query are then scored together with numpy rather than one at a time, and a batch of
+    queries is scored as a matrix product of the candidates' and queries' trigrams.
+    """
+
+    # number of candidate keys scored at a time in a batch, to limit memory use
+    block_size = 4096
+
+    def __init__(self, keys=()):
+        if numpy is None:
+            raise ImportError("numpy is needed to use the numpy scorer")
+
+        # gram => gram id, and key => position in the packed arrays
+        self.vocabulary = {}
+        self.positions = {}
+        grams = []
+        offsets = [0]
+        for key in keys:
+            self.positions[key] = len(self.positions)
+            grams.extend( sorted( self.gram_ids(key, add=True) ) )
+            offsets.append( len(grams) )
+
+        self.grams = numpy.array(grams, dtype=numpy.int32)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.lengths = numpy.diff(self.offsets)
+        # the length of each key in characters
+        self.key_lengths = numpy.array([ len(key) for key in keys ], dtype=numpy.int64)
+
+    def get_grams(self, key):
+        """ The set of trigrams of a key, padded with spaces so short keys have trigrams
+            and the start and end of the key count for more
+        """
+        key = " " + key + " "
+        if len(key) < 3:
+            return set([key])
+        return set( key[x:x+3] for x in range(len(key) - 2) )
+
+    def gram_ids(self, key, add=False):
+        """ The ids of a key's trigrams - grams which aren't in the vocabulary are
+            added to it, or given an id of -1 if `add` is false
+        """
+        ids = []
+        for g in self.get_grams(key):
+            if g not in self.vocabulary:
+                if not add:
+                    ids.append(-1)
+                    continue
+                self.vocabulary[g] = len(self.vocabulary)
+            ids.append(self.vocabulary[g])
+        return ids
+
+    def gather(self, keys):
+        """ Return the lengths of the keys (in characters), and for each trigram of the 
+            keys its gram id and the index (in `keys`) of the key it belongs to
+        """
+        positions = numpy.array([ self.positions[k] for k in keys ], dtype=numpy.int64)
+        starts = self.offsets[positions]
+        lengths = self.lengths[positions]
+        owners = numpy.repeat( numpy.arange(len(keys)), lengths )
+        index = numpy.arange(lengths.sum()) - numpy.repeat( numpy.cumsum(lengths) - lengths, lengths ) + numpy.repeat( starts, lengths )
+        return self.key_lengths[positions], self.grams[index], owners
+
+    def ratio(self, shared, key_lengths, query_string, keys):
+        """ Turn the number of trigrams each key shares with the query into a score of 
+            0-100, like the SequenceMatcher ratio. Only exact matches score 100, so other
+            keys are kept just below that
+        """
+        query_length = len(query_string)
+        matched = numpy.where( shared > 0, numpy.minimum( shared + 2, numpy.minimum(key_lengths, query_length) ), 0 )
+        if query_length < 3:
+            matched = numpy.array([ query_length if query_string in k else 0 for k in keys ])
+        total = key_lengths + query_length
+        scores = 200.0 * matched / numpy.maximum(total, 1)
+        return numpy.minimum(scores, 99.99)
+
+    def best(self, scores, keys, limit):
+        """ Return the (score, key) tuples for the `limit` highest scores
+        """
+        if limit and limit < len(scores):
+            top = numpy.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = numpy.arange(len(scores))
+        top = top[ numpy.argsort(-scores[top], kind="mergesort") ]
+        return [ (float(scores[n]), keys[n]) for n in top ]
+
+    def top_scores(self, query_string, keys, limit=None):
+        keys = list(keys)
+        if not keys:
+            return []
+
+        query_grams = numpy.array( sorted(set(self.gram_ids(query_string))), dtype=numpy.int32 )
+        key_lengths, grams, owners = self.gather(keys)
+        shared = numpy.bincount( owners, weights=numpy.in1d(grams, query_grams[query_grams >= 0]), minlength=len(keys) )
+        return self.best( self.ratio(shared, key_lengths, query_string, keys), keys, limit )
+
+    def top_scores_many(self, query_strings, keys, limits):
+        """ Score a batch of queries together
+
+        The candidates of all the queries are scored against all the queries at once,
+        as a (candidates x trigrams) matrix multiplied by a (trigrams x queries) matrix,
+        then each query's scores are picked out for its own candidates
+        """
+        keys = [ list(k) for k in keys ]
+        if len(query_strings) <= 1:
+            return [ self.top_scores(q, k, l) for q, k, l in zip(query_strings, keys, limits) ]
+
+        # the columns of the matrices are the trigrams found in any of the queries
+        query_ids = [ set(i for i in self.gram_ids(q) if i >= 0) for q in query_strings ]
+        columns = numpy.array( sorted( set().union(*query_ids) ), dtype=numpy.int32 )
+        queries = numpy.zeros( (len(columns), len(query_strings)), dtype=numpy.float32 )
+        for n, ids in enumerate(query_ids):
+            queries[ numpy.searchsorted(columns, sorted(ids)), n ] = 1
+
+        # score every candidate key once, against every query
+        candidates = sorted( set().union(*keys) )
+        rows = dict( (k, n) for n, k in enumerate(candidates) )
+        shared = numpy.zeros( (len(candidates), len(query_strings)), dtype=numpy.float32 )
+        lengths = numpy.zeros( len(candidates) )
+        for start in range(0, len(candidates), self.block_size):
+            block = candidates[start:start + self.block_size]
+            block_lengths, grams, owners = self.gather(block)
+            lengths[start:start + len(block)] = block_lengths
+            if not len(columns):
+                continue
+            cols = numpy.minimum( numpy.searchsorted(columns, grams), len(columns) - 1 )
+            found = columns[cols] == grams
+            matrix = numpy.zeros( (len(block), len(columns)), dtype=numpy.float32 )
+            matrix[ owners[found], cols[found] ] = 1
+            shared[start:start + len(block)] = matrix.dot(queries)
+
+        results = []
+        for n, (k, limit) in enumerate(zip(keys, limits)):
+            if not k:
+                results.append([])
+                continue
+            r = numpy.array([ rows[i] for i in k ])
+            scores = self.ratio( shared[r, n], lengths[r], query_strings[n], k )
+            results.append( self.best(scores, k, limit) )
+        return results
+
+# scorers which can be chosen by name
+SCORERS = {
+    "difflib": ReconcileScorer,
+    "numpy": ReconcileScorerNumpy,
+}
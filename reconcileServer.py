@@ -0,0 +1,119 @@
+import bottle
+
+import Queue
+import threading
+import wsgiref.simple_server
+
+# servers that can be chosen with the --server option, as well as the threaded server below
+SERVERS = ["wsgiref", "threaded", "paste", "waitress", "cheroot", "gunicorn", "tornado"]
+# servers which handle requests in a pool of threads
+THREADED_SERVERS = ["threaded", "paste", "waitress", "cheroot"]
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    """ wsgiref server which hands each connection to a fixed pool of threads,
+        so one slow request doesn't hold up all the others
+
+    Connections are queued until a thread is free. Once `queue_size` connections
+    are waiting the server stops accepting new ones, and they wait in the listen
+    backlog (`request_queue_size`) instead
+    """
+
+    threads = 10
+    queue_size = 100
+    request_queue_size = 50
+    daemon_threads = True
+
+    def server_activate(self):
+        wsgiref.simple_server.WSGIServer.server_activate(self)
+        self.requests = Queue.Queue(self.queue_size)
+        for n in range(self.threads):
+            t = threading.Thread(target=self.process_requests)
+            t.daemon = self.daemon_threads
+            t.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put( (request, client_address) )
+
+    def process_requests(self):
+        """ Handle connections from the queue, run by each thread in the pool
+        """
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+class ReconcileThreadedServer(bottle.WSGIRefServer):
+    """ bottle server adapter for the ThreadPoolWSGIServer
+
+    Takes `threads`, `queue_size` and `backlog` options
+    """
+
+    def run(self, app):
+        options = self.options
+
+        class server_class(ThreadPoolWSGIServer):
+            threads = options.get("threads") or ThreadPoolWSGIServer.threads
+            queue_size = options.get("queue_size") or ThreadPoolWSGIServer.queue_size
+            request_queue_size = options.get("backlog") or ThreadPoolWSGIServer.request_queue_size
+
+        self.options["server_class"] = server_class
+        bottle.WSGIRefServer.run(self, app)
+
+def get_server(server, threads=None, workers=None, backlog=None, keep_alive=None, queue_size=None):
+    """ Return the server adapter and options to pass to bottle.run for a server
+
+    Each server has its own names for the settings, so they are translated here. Settings
+    a server doesn't support are left out. `workers` are processes forked by the server
+    after the app (and so the index) has been created.
+    """
+
+    if server == "threaded":
+        options = {"threads": threads, "queue_size": queue_size, "backlog": backlog}
+        server = ReconcileThreadedServer
+    elif server == "paste":
+        options = {
+            "use_threadpool": True,
+            "threadpool_workers": threads,
+            "request_queue_size": backlog,
+            "protocol_version": "HTTP/1.1" if keep_alive else None,
+            "socket_timeout": keep_alive,
+        }
+    elif server == "waitress":
+        options = {
+            "threads": threads,
+            "backlog": backlog,
+            "connection_limit": queue_size,
+            "channel_timeout": keep_alive,
+        }
+    elif server == "cheroot":
+        options = {
+            "numthreads": threads,
+            "request_queue_size": backlog,
+            "accepted_queue_size": queue_size,
+            "timeout": keep_alive,
+        }
+    elif server == "gunicorn":
+        options = {
+            "workers": workers,
+            "threads": threads,
+            "backlog": backlog,
+            "keepalive": keep_alive,
+        }
+    else:
+        options = {}
+
+    return server, dict( (k, v) for k, v in options.items() if v is not None )
+
+def is_threaded_server(server, threads=None):
+    """ Whether a server handles more than one request at the same time in each process.
+        gunicorn's workers only use threads if there is more than one
+    """
+    if threads is not None and threads < 2:
+        return False
+    if server == "gunicorn":
+        return threads is not None
+    return server in THREADED_SERVERS
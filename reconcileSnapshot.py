@@ -0,0 +1,293 @@
+""" Compact binary snapshot files, which are read with mmap
+
+A snapshot is made up of named sections, each of which is either an array of integers
+or a table of variable-length strings. A table is stored as the strings packed one after
+another, followed by an array of the offsets of each string, so any string can be read
+without reading the others. The details of the sections are stored as JSON at the end
+of the file.
+
+Opening a snapshot only reads this JSON - everything else is read from the memory map
+as it's needed, so it's quick to open and processes reading the same file share the
+same pages of memory.
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = "RCSNAP01"
+# end of the file: position of the JSON details, then the magic string again
+FOOTER = struct.Struct("<Q8s")
+
+# struct formats of the integers in arrays, by whether they are signed and their size
+FORMATS = {
+    (True, 4): "=i",
+    (True, 8): "=q",
+    (False, 4): "=I",
+    (False, 8): "=Q",
+}
+
+class ReconcileSnapshotError(Exception):
+    """ Raised when a file isn't a snapshot that can be read
+    """
+    pass
+
+class ReconcileSnapshotWriter:
+    """ Writes the sections of a snapshot to a file
+
+    The snapshot is written to a temporary file which replaces `filename` once it has
+    been closed, so processes which still have the old file open can carry on using it
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.temp_filename = "%s.%s.tmp" % (filename, os.getpid())
+        self.f = open(self.temp_filename, "wb")
+        self.f.write(MAGIC)
+        self.sections = {}
+
+    def align(self):
+        """ Pad the file so the next section starts on an 8 byte boundary
+        """
+        padding = -self.f.tell() % 8
+        self.f.write("\0" * padding)
+        return self.f.tell()
+
+    def write_array(self, name, values):
+        """ Write an array.array of integers
+        """
+        position = self.align()
+        values.tofile(self.f)
+        self.sections[name] = {
+            "type": "array",
+            "typecode": values.typecode,
+            "itemsize": values.itemsize,
+            "position": position,
+            "length": len(values),
+        }
+
+    def write_table(self, name, strings):
+        """ Write a table of strings, from an iterable of byte strings
+        """
+        position = self.align()
+        offsets = array.array("I", [0])
+        end = 0
+        for s in strings:
+            self.f.write(s)
+            end += len(s)
+            try:
+                offsets.append(end)
+            except OverflowError:
+                # more than 4GB of strings, so switch to 8 byte offsets
+                offsets = array.array("L", offsets)
+                if offsets.itemsize < 8:
+                    raise ReconcileSnapshotError("Table '%s' is too large for a snapshot" % name)
+                offsets.append(end)
+        self.write_array(name + ".offsets", offsets)
+        self.sections[name] = {
+            "type": "table",
+            "position": position,
+            "length": len(offsets) - 1,
+        }
+
+    def write_postings(self, name, lists):
+        """ Write a list of lists of integers (like the row ids for each key), as the
+            integers of all the lists in one array with the offset of each list in another
+        """
+        values = array.array("i")
+        offsets = array.array("I", [0])
+        for l in lists:
+            values.extend(l)
+            offsets.append(len(values))
+        self.write_array(name, values)
+        self.write_array(name + ".offsets", offsets)
+
+    def close(self, meta=None):
+        """ Write the details of the sections (along with any other `meta` data) and
+            replace the snapshot file with the new one
+        """
+        meta = dict(meta or {})
+        meta["sections"] = self.sections
+        meta["byteorder"] = sys.byteorder
+        position = self.align()
+        self.f.write( json.dumps(meta) )
+        self.f.write( FOOTER.pack(position, MAGIC) )
+        self.f.close()
+        os.rename(self.temp_filename, self.filename)
+
+    def abort(self):
+        """ Throw away the snapshot being written
+        """
+        self.f.close()
+        os.remove(self.temp_filename)
+
+def parse_snapshot_meta(buffer):
+    """ Return the details stored at the end of the contents of a snapshot (a string or
+        mmap), or None if it isn't a snapshot
+    """
+    end = len(buffer) - FOOTER.size
+    if end < 0:
+        return None
+    try:
+        position, magic = FOOTER.unpack( buffer[end:end + FOOTER.size] )
+        if magic != MAGIC or position > end:
+            return None
+        return json.loads( buffer[position:end] )
+    except (ValueError, struct.error):
+        return None
+
+class ReconcileSnapshot:
+    """ A snapshot file, opened with mmap
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        # the details are read from the memory map rather than opening the file again,
+        # so they describe the same file even if a new snapshot replaces it meanwhile
+        try:
+            self.file = open(filename, "rb")
+        except IOError:
+            raise ReconcileSnapshotError("'%s' is not a snapshot file" % filename)
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # an empty file can't be mapped
+            self.file.close()
+            raise ReconcileSnapshotError("'%s' is not a snapshot file" % filename)
+
+        self.meta = parse_snapshot_meta(self.buffer)
+        error = None
+        if self.meta is None:
+            error = "'%s' is not a snapshot file"
+        elif self.meta["byteorder"] != sys.byteorder:
+            error = "'%s' was written on a machine with a different byte order"
+        if error is not None:
+            self.close()
+            raise ReconcileSnapshotError(error % filename)
+
+    def array(self, name):
+        """ Return an array section
+        """
+        section = self.meta["sections"][name]
+        return ReconcileSnapshotArray(self.buffer, section["position"], section["length"], section["typecode"], section["itemsize"])
+
+    def table(self, name):
+        """ Return a table section
+        """
+        section = self.meta["sections"][name]
+        return ReconcileSnapshotTable(self.buffer, section["position"], self.array(name + ".offsets"))
+
+    def postings(self, name):
+        """ Return a postings section
+        """
+        return ReconcileSnapshotPostings(self.array(name), self.array(name + ".offsets"))
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+class ReconcileSnapshotArray(object):
+    """ An array of integers in a snapshot, which behaves like a read-only list
+    """
+
+    __slots__ = ("buffer", "position", "length", "typecode", "itemsize", "struct")
+
+    def __init__(self, buffer, position, length, typecode, itemsize):
+        self.buffer = buffer
+        self.position = position
+        self.length = length
+        self.typecode = typecode
+        self.itemsize = itemsize
+        self.struct = struct.Struct( FORMATS[(typecode.islower(), itemsize)] )
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.length
+        if not 0 <= n < self.length:
+            raise IndexError("snapshot array index out of range")
+        return self.struct.unpack_from(self.buffer, self.position + n * self.itemsize)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self.length, 4096):
+            for v in self.slice(start, min(self.length, start + 4096)):
+                yield v
+
+    def slice(self, start, end):
+        """ Return the values from `start` to `end` as an array.array
+        """
+        values = array.array(self.typecode)
+        values.fromstring( self.buffer[self.position + start * self.itemsize:self.position + end * self.itemsize] )
+        return values
+
+class ReconcileSnapshotTable(object):
+    """ A table of strings in a snapshot, which behaves like a read-only list. If the
+        strings were written in sorted order they can be found with `find`
+    """
+
+    __slots__ = ("buffer", "position", "offsets")
+
+    def __init__(self, buffer, position, offsets):
+        self.buffer = buffer
+        self.position = position
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("snapshot table index out of range")
+        return self.buffer[self.position + self.offsets[n]:self.position + self.offsets[n + 1]]
+
+    def __iter__(self):
+        for start in xrange(0, len(self), 4096):
+            for s in self.slice(start, min(len(self), start + 4096)):
+                yield s
+
+    def slice(self, start, end):
+        """ Return the strings from `start` to `end` as a list
+        """
+        offsets = self.offsets.slice(start, end + 1)
+        position = self.position
+        buffer = self.buffer
+        return [ buffer[position + offsets[n]:position + offsets[n + 1]] for n in xrange(len(offsets) - 1) ]
+
+    def find(self, s):
+        """ Return the position of a string in a sorted table, or -1 if it isn't there
+        """
+        n = bisect.bisect_left(self, s)
+        if n < len(self) and self[n] == s:
+            return n
+        return -1
+
+class ReconcileSnapshotPostings(object):
+    """ Lists of integers in a snapshot. `postings[n]` returns the nth list as an
+        array.array
+    """
+
+    __slots__ = ("values", "offsets")
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return self.values.slice( self.offsets[n], self.offsets[n + 1] )
+
+    def length(self, n):
+        """ The length of the nth list, without reading it
+        """
+        return self.offsets[n + 1] - self.offsets[n]
@@ -1,138 +1,576 @@
-import difflib
-import re
-import string
+from reconcileNormaliser import *
+from reconcileScorer import *
+from reconcileMetrics import *
+
+import array
+import bisect
+import heapq
+import itertools
+import math
+import threading
+from collections import OrderedDict
+
+def record_fields(names):
+    """ Create the field name => position lookup shared by ReconcileRecords read
+        from the same source
+    """
+    return OrderedDict( (name, n) for n, name in enumerate(names) )
+    
+class ReconcileRecord(object):
+    """ A compact row of the source, which behaves like a read-only dict
+    
+    The values are held in a tuple, and the field names are shared between all the
+    records from the same source rather than being repeated in every row
+    """
+    
+    __slots__ = ("_fields", "_values")
+    
+    def __init__(self, fields, values):
+        self._fields = fields
+        self._values = tuple(values)
+        
+    def __getitem__(self, name):
+        try:
+            return self._values[self._fields[name]]
+        except IndexError:
+            # a short row, like csv.DictReader treat the missing values as None
+            return None
+            
+    def __contains__(self, name):
+        return name in self._fields
+        
+    def __iter__(self):
+        return iter(self._fields)
+        
+    def __len__(self):
+        return len(self._fields)
+        
+    def __eq__(self, other):
+        if isinstance(other, ReconcileRecord):
+            return self.items() == other.items()
+        return self.to_dict() == other
+        
+    def __ne__(self, other):
+        return not self == other
+        
+    def __repr__(self):
+        return "ReconcileRecord(%r)" % (self.items(),)
+        
+    def get(self, name, default=None):
+        if name in self._fields:
+            return self[name]
+        return default
+        
+    def keys(self):
+        return list(self._fields)
+        
+    def values(self):
+        return [ self[k] for k in self._fields ]
+        
+    def items(self):
+        return [ (k, self[k]) for k in self._fields ]
+        
+    def to_dict(self):
+        """ Return the record as a dict, keeping the order of the fields
+        """
+        return OrderedDict(self.items())
 
 class ReconcileStorageDict:
     """ Default storage/retrieval engine - holds the data as key:value dictionaries
+    
+    Each normalised name is a key of the dictionary, pointing to the ids of all the rows 
+    with that name, so rows with duplicate names are kept but only scored once.
+    
+    Alongside the dictionary an inverted index of character n-grams is kept, so that
+    a search only needs to look at the keys which share n-grams with the query. The 
+    candidate keys are then scored by a ReconcileScorer - `scorer` can be "difflib"
+    (the default) or "numpy"
+    
+    The keys are also kept in a sorted list, so names starting with a prefix can be
+    found with a binary search.
+    
+    If that doesn't find enough keys, a query with more than one word also finds keys 
+    which share words with it, in any order, using an index of word => keys. The rarest 
+    words of the query are looked up first, and the keys are scored by the words they 
+    share, with rare words counting for more (IDF weighting) - so "council hartlepool 
+    borough" finds "Hartlepool Borough Council".
+    
+    Queries with properties are matched using an index of the exact values of each 
+    property's field. Only the fields in `property_fields` are indexed, when the storage 
+    is created - properties of other fields are ignored, so a query can't make the 
+    storage index a field of every row
+    
+    If a `previous` version of the storage is given (when the source has been updated)
+    then names it has already normalised aren't normalised again, and its n-gram index 
+    is copied and updated with the keys that have been added or removed
     """
+    
+    # length of the character n-grams used in the inverted index
+    ngram_size = 3
+    # most keys scored for sharing words with a query
+    max_token_candidates = 1000
+    # most rows matching a query's properties which are scored without looking at the 
+    # name first
+    max_property_rows = 1000
+    # names starting with a prefix looked at for each suggestion, to find the shortest
+    prefix_candidates = 20
 
-    def __init__(self, source, search_field, id_field):
+    def __init__(self, source, search_field, id_field, normalise_options=None, scorer="difflib", property_fields=None, previous=None):
     
         # the field the will be searched by default
         self.search_field = search_field
         # the field that will be used to index
         self.id_field = id_field
+        # turns names into the keys of the dict
+        self.normaliser = ReconcileNormaliser(normalise_options)
         
-        # create the dict
+        # the rows of the source - a row's position in the list is its row id
+        self.rows = []
+        # the normalised name of each row
+        self.row_keys = []
+        # create the dict of normalised name => array of row ids
         self.docs = {}
+        # inverted index of n-gram => set of keys containing that n-gram
+        self.ngrams = {}
+        # index of id => record
+        self.ids = {}
+        # index of word => set of keys containing that word
+        self.tokens = {}
+        
+        # names which the previous version of the storage has already normalised
+        known = {}
+        previous_docs = {}
+        if previous is not None:
+            known = dict( itertools.izip( (i[self.search_field] for i in previous.rows), previous.row_keys ) )
+            previous_docs = previous.docs
+            self.ngrams = dict( (g, set(keys)) for g, keys in previous.ngrams.iteritems() )
+            self.tokens = dict( (t, set(keys)) for t, keys in previous.tokens.iteritems() )
+        
+        # add documents to index, normalising the names as they are read
+        source, names = itertools.tee(source)
+        names = ( i[self.search_field] for i in names )
+        if known:
+            names = itertools.imap( lambda n: known[n] if n in known else self.normaliser.normalise(n), names )
+        else:
+            names = self.normaliser.normalise_many( names )
+        for i, key in itertools.izip(source, names):
+            if key not in self.docs:
+                if key not in previous_docs:
+                    self.index_key(key)
+                self.docs[key] = array.array('i')
+            self.docs[key].append( len(self.rows) )
+            self.rows.append(i)
+            self.row_keys.append(key)
+            self.ids[i[self.id_field]] = i
+            
+        # remove the keys which are no longer in the source from the copied n-gram index
+        for key in previous_docs:
+            if key not in self.docs:
+                self.unindex_key(key)
+            
+        # sorted list of keys, for finding keys starting with a prefix
+        self.sorted_keys = sorted(self.docs)
+        # scores the candidates for a query
+        self.scorer = SCORERS[scorer](self.docs)
+        
+        # indexes of field => normalised value => array of row ids
+        self.columns = {}
+        for field in property_fields or []:
+            self.index_column(field)
+            
+    def after_fork(self):
+        """ Replace the storage's locks in a process forked from this one, as other 
+            threads may have been holding them when it was forked
+        """
+        self.normaliser.cache.lock = threading.Lock()
+            
+    def key_rows(self, key, limit=None):
+        """ Return the rows which have a particular normalised name, or the first `limit` 
+            of them
+        """
+        rows = self.docs[key]
+        if limit:
+            rows = rows[0:limit]
+        return [ self.rows[r] for r in rows ]
+            
+    def index_column(self, field):
+        """ Build the index of normalised value => row ids for a field. Fields which 
+            aren't in the source aren't indexed
+        """
+        if not self.rows or field not in self.rows[0]:
+            return
+        
+        index = {}
+        for n, i in enumerate(self.rows):
+            if i[field] is None:
+                continue
+            index.setdefault( self.normaliser.normalise_value(i[field]), array.array('i') ).append(n)
+        self.columns[field] = index
+        
+    def column_index(self, field):
+        """ Return the index of normalised value => row ids for a field, or None if the
+            field hasn't been indexed
+        """
+        return self.columns.get(field)
+        
+    def property_rows(self, q):
+        """ For each property of a query which is an indexed field, return the set of 
+            row ids which match one of the property's values
+        """
+        properties = []
+        for field, values in q.property_values():
+            index = self.column_index(field)
+            if index is None:
+                continue
+            rows = set()
+            for v in values:
+                rows.update( index.get( self.normaliser.normalise_value(v), () ) )
+            properties.append(rows)
+        return properties
+        
+    def get_ngrams(self, key):
+        """ Return the set of n-grams found in a key. Keys shorter than the n-gram 
+            size are used as an n-gram themselves so they can still be found
+        """
+        n = self.ngram_size
+        if len(key) < n:
+            return set([key])
+        return set( key[x:x+n] for x in range(len(key) - n + 1) )
+        
+    def index_key(self, key):
+        """ Add a key to the n-gram and word indexes
+        """
+        for g in self.get_ngrams(key):
+            self.ngrams.setdefault(g, set()).add(key)
+        for t in set(key.split()):
+            self.tokens.setdefault(t, set()).add(key)
+            
+    def unindex_key(self, key):
+        """ Remove a key from the n-gram and word indexes
+        """
+        for index, terms in ((self.ngrams, self.get_ngrams(key)), (self.tokens, set(key.split()))):
+            for term in terms:
+                keys = index.get(term)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[term]
+            
+    def candidates(self, query_string):
+        """ Find the keys which contain the query string, using the n-gram index
+            to avoid looking at every key
+        """
         
-        # add documents to index
-        for i in source:
-            key = i[self.search_field]
-            key = self.normalise_name(key)
-            self.docs[key] = i
+        # a long query can only be found in keys containing all of its n-grams,
+        # so start from the rarest one
+        if len(query_string) >= self.ngram_size:
+            postings = [ self.ngrams.get(g, ()) for g in self.get_ngrams(query_string) ]
+            postings = min(postings, key=len)
+        
+        # a short query must sit inside one of the n-grams of any key containing it
+        else:
+            postings = set()
+            for g in self.ngrams:
+                if query_string in g:
+                    postings.update( self.ngrams[g] )
+        
+        return [ i for i in postings if query_string in i ]
+        
+    def token_weight(self, token):
+        """ The weight of a word, by its inverse document frequency - rare words say more
+            about a name than common ones
+        """
+        return math.log( (len(self.docs) + 1.0) / (len(self.tokens.get(token, ())) + 1.0) ) + 1.0
+        
+    def token_candidates(self, tokens):
+        """ Find the keys which share words with a query. The rarest words are looked up 
+            first, stopping before there are more than `max_token_candidates` keys (but 
+            always including the keys with the rarest word)
+        """
+        candidates = set()
+        for t in sorted(tokens, key=lambda t: len(self.tokens.get(t, ()))):
+            keys = self.tokens.get(t)
+            if not keys:
+                continue
+            if candidates and len(candidates) + len(keys) > self.max_token_candidates:
+                break
+            candidates.update(keys)
+        return candidates
+        
+    def token_scores(self, query_string, limit=None):
+        """ Score the keys which share words with a query of more than one word, whatever 
+            order the words are in, returning a list of (score, key) tuples best first
+        
+        The score is the weight of the words the key and query share, as a proportion of 
+        the weight of all their words. As the words may not be in the same order only 
+        the exact match scores 100, so other keys are kept just below that
+        """
+        tokens = set(query_string.split())
+        if len(tokens) < 2:
+            return []
+        
+        weights = dict( (t, self.token_weight(t)) for t in tokens )
+        query_weight = sum( weights.values() )
+        scores = []
+        for key in self.token_candidates(tokens):
+            if key == query_string:
+                continue
+            shared = key_weight = 0.0
+            for t in set(key.split()):
+                w = weights.get(t)
+                if w is None:
+                    w = weights[t] = self.token_weight(t)
+                key_weight += w
+                if t in tokens:
+                    shared += w
+            score = 200.0 * shared / ( query_weight + key_weight )
+            scores.append( (min(score, 99.99), key) )
+        
+        if limit:
+            return heapq.nlargest(limit, scores)
+        return sorted(scores, reverse=True)
         
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type="", exc_value="", traceback=""):
+        self.rows = []
+        self.row_keys = []
         self.docs = {}
+        self.ngrams = {}
+        self.ids = {}
+        self.tokens = {}
+        self.columns = {}
+        self.sorted_keys = []
         
     def close(self):
         self.__exit__()
     
     def search(self, q):
         """ Search for a query string in the dictionary
+        
+        If the query has a limit then only the best `q.limit` hits are returned
         """
-    
-        query_string = self.normalise_name(q.query)
-        results = []
-        matches = []
-        
-        # check for exact matches
-        if( query_string in self.docs ):
-            r = ReconcileHit( self.docs[query_string], 100 )
-            results.append( r )
-            matches.append( self.docs[query_string] ) 
-        
-        # otherwise iterate through all the docs and return anything containing the query
-        for i in self.docs:
-            if query_string in i and self.docs[i] not in matches:
-                score = difflib.SequenceMatcher(None, query_string, i)
-                score = (score.ratio() * 100)
-                r = ReconcileHit( self.docs[i], score )
-                results.append( r )
+        return self.search_many([q])[0]
+        
+    def search_many(self, qs):
+        """ Search for a list of queries, returning a list of hits for each one
+        
+        The candidates for all the queries are scored together, so a scorer that 
+        works on batches can score them in one go
+        """
+        
+        hits = [ None ] * len(qs)
+        searches = []
+        for n, q in enumerate(qs):
+            with metrics.timer("stage_seconds", stage="normalise"):
+                query_string = self.normaliser.normalise_query(q.query)
+            
+            # queries with properties are matched on them first
+            properties = self.property_rows(q)
+            if properties:
+                with metrics.timer("stage_seconds", stage="properties"):
+                    hits[n] = self.search_properties(q, query_string, properties)
+                if hits[n] is not None:
+                    continue
+            
+            results = []
+            
+            # check for exact matches
+            if( query_string in self.docs ):
+                for i in self.key_rows(query_string, q.limit):
+                    results.append( ReconcileHit( i, 100 ) )
+            
+            # otherwise look through the candidate keys for the best ones containing the query.
+            # Every key has at least one row, so the best rows will be found in the best `limit` keys
+            limit = q.limit and q.limit - len(results)
+            candidates = []
+            if limit is None or limit > 0:
+                with metrics.timer("stage_seconds", stage="candidates"):
+                    candidates = [ i for i in self.candidates(query_string) if i != query_string ]
+            metrics.observe("candidates", len(candidates))
+            searches.append( (n, q, query_string, results, limit, candidates) )
+        
+        with metrics.timer("stage_seconds", stage="score"):
+            scores = self.scorer.top_scores_many(
+                [ s[2] for s in searches ], 
+                [ s[5] for s in searches ], 
+                [ s[4] for s in searches ],
+                )
+        
+        for (n, q, query_string, results, limit, candidates), top in zip(searches, scores):
+            
+            # if there aren't enough keys containing the query, add the keys which share words
+            # with it, keeping the best score for each key
+            if limit is None or len(top) < limit:
+                with metrics.timer("stage_seconds", stage="tokens"):
+                    token_top = self.token_scores(query_string, limit)
+                if token_top:
+                    best = dict( (key, score) for score, key in token_top )
+                    for score, key in top:
+                        best[key] = max(score, best.get(key, 0))
+                    top = [ (score, key) for key, score in best.items() ]
+                    top = heapq.nlargest(limit, top) if limit else sorted(top, reverse=True)
+            
+            for score, key in top:
+                if q.limit and len(results) >= q.limit:
+                    break
+                for i in self.key_rows(key, q.limit and q.limit - len(results)):
+                    results.append( ReconcileHit( i, score ) )
+            if q.limit:
+                results = results[0:q.limit]
+            hits[n] = results
         
+        return hits
+        
+    def search_properties(self, q, query_string, properties):
+        """ Search for a query using its properties, given the sets of rows matching 
+            each property
+        
+        The candidates are the rows which match all of the properties, or if there are 
+        none, the rows which match any of them. Each row's score is the average of the 
+        score for its name and 100 for each property it matches. Returns None if no 
+        rows match any of the properties
+        
+        If more than `max_property_rows` rows match then the properties don't narrow 
+        down the search much, so the names containing the query (found using the n-gram
+        index) are scored instead, and the rows with those names which match the 
+        properties are picked out, starting from the best name. None is returned if 
+        there aren't any
+        """
+        rows = set.intersection(*properties)
+        matched_all = bool(rows)
+        if not rows:
+            rows = set.union(*properties)
+        if not rows:
+            return None
+        
+        # when every row matches all the properties the best rows have the best names, 
+        # so only the best names need scoring
+        limit = q.limit if matched_all else None
+        
+        # list of (name score, rows with that name)
+        if not query_string:
+            name_rows = [ (0, rows) ]
+        elif len(rows) > self.max_property_rows:
+            name_rows = self.property_candidates(query_string, rows, limit)
+            if not name_rows:
+                return None
+        else:
+            key_rows = {}
+            for r in rows:
+                key_rows.setdefault(self.row_keys[r], []).append(r)
+            scores = self.scorer.top_scores(query_string, [ k for k in key_rows if k != query_string ], limit)
+            if query_string in key_rows:
+                scores.insert(0, (100, query_string))
+            name_rows = [ (score, key_rows[k]) for score, k in scores ]
+        
+        weight = 1 if query_string else 0
+        scored = []
+        for name_score, key_rows in name_rows:
+            for r in key_rows:
+                matched = sum( 1 for p in properties if r in p )
+                score = ( weight * name_score + 100.0 * matched ) / ( weight + len(properties) )
+                scored.append( (score, r) )
+        
+        if q.limit:
+            scored = heapq.nlargest(q.limit, scored)
+        else:
+            scored = sorted(scored, reverse=True)
+        return [ ReconcileHit( self.rows[r], score ) for score, r in scored ]
+        
+    def property_candidates(self, query_string, rows, limit=None):
+        """ Score the keys containing a query string, and return a list of (score, row 
+            ids) for the keys with rows in `rows`, best first. With a `limit`, keys are 
+            only looked at until there are enough rows - more keys are scored if the 
+            best ones don't have enough
+        """
+        keys = [ k for k in self.candidates(query_string) if k != query_string ]
+        score_limit = limit
+        while True:
+            scores = self.scorer.top_scores(query_string, keys, score_limit)
+            if query_string in self.docs:
+                scores.insert(0, (100, query_string))
+            
+            name_rows = []
+            found = 0
+            for score, k in scores:
+                if limit and found >= limit:
+                    return name_rows
+                matching = [ r for r in self.docs[k] if r in rows ]
+                if matching:
+                    name_rows.append( (score, matching) )
+                    found += len(matching)
+            if not score_limit or len(scores) < score_limit or found >= limit:
+                return name_rows
+            score_limit *= 4
+        
+    def prefix_search(self, prefix, limit=10):
+        """ Return hits for rows whose normalised name starts with a prefix. Shorter 
+            names get a higher score, as more of the name has been typed. The shortest 
+            names are picked from the first `prefix_candidates` * `limit` names starting 
+            with the prefix, in alphabetical order
+        """
+        prefix = self.normaliser.normalise(prefix, partial=True)
+        keys = []
+        n = bisect.bisect_left(self.sorted_keys, prefix)
+        while n < len(self.sorted_keys) and self.sorted_keys[n].startswith(prefix):
+            keys.append(self.sorted_keys[n])
+            if limit and len(keys) >= limit * self.prefix_candidates:
+                break
+            n += 1
+        
+        # stable sort, so names of the same length stay in alphabetical order
+        keys.sort(key=len)
+        results = []
+        for key in keys:
+            score = 100.0 * len(prefix) / len(key) if key else 100.0
+            for i in self.key_rows(key, limit and limit - len(results)):
+                results.append( ReconcileHit( i, score ) )
+            if limit and len(results) >= limit:
+                break
         return results
         
-    def all(self):
-        """ return all the values
+    def cache_key(self, query):
+        """ return a key for caching the results of a query - queries with the same
+            normalised name get the same results
+        """
+        return self.normaliser.normalise_query(query)
+        
+    def all(self, offset=0, limit=None):
+        """ return an iterator over the values, starting at row `offset` and returning
+            up to `limit` rows
         """
-        return self.docs.values()
+        stop = self.count() if limit is None else min(offset + limit, self.count())
+        return ( self.rows[n] for n in xrange(offset, stop) )
+        
+    def count(self):
+        """ return the number of rows
+        """
+        return len(self.rows)
+        
+    def get_by_id(self, id):
+        """ return the record with a particular id, or None if there isn't one
+        """
+        return self.ids.get(id)
         
     def __getattr__(self, name):
-        for i in self.docs:
-            if( self.docs[i][self.id_field]==name ):
-                return self.docs[i]
+        if not name.startswith("__") and "ids" in self.__dict__:
+            result = self.get_by_id(name)
+            if result is not None:
+                return result
         
         raise AttributeError("ReconcileStorageDict instance has no attribute '%s'" % name)
     
-    def normalise_name(self, str, options={}):
+    def normalise_name(self, str, options=None):
         """ Produce a normalised string from a given string, to remove
             the influence of lower/upper-case etc on matching
+            
+        Uses the storage's normaliser unless different options are given
         """
-    
-
-        default_options = {
-            "reorder": False,       # if true then the words in the string are reordered into alphabetical order
-            "remspaces": False,     # if true then all spaces between words are removed.
-            "rembrackets": False,   # if true then any words within brackets are removed.
-            "replacewords": True,   # if true then particular words are removed from the string.
-            
-            # an array of the words that will be removed from the string. Values in the array can either be a string, in which case the word will be removed from anywhere in str, or an array with attributes "name" (the word) and "type" (beginning|middle|end) specifying where the word will be removed.
-            "words":[
-                {"name":"the",      "type":"beginning"}, 
-                {"name":"the",      "type":"end"},
-            ]
-        }
-
-        # set default options where no option is set
-        for key in default_options:
-            if( key not in options):
-                options[key] = default_options[key]
-                
-        str = str.lower()                           # make the string lowercase
-        str = str.replace("&"," and ")              # replace any ampersands with " and "
-        
-        # if we've chosen to remove brackets
-        if(options["rembrackets"]):
-            preg_brackets = r'\([^)]*\)'            # regex expression for brackets
-            str = re.sub( preg_brackets, "", str)   # replace any text in the brackets
-        
-        str = str.replace("'","")                   # replace any apostrophes
-        preg_nonalpha = r'[^a-zA-Z0-9 ]'            # regex expression for non-alphabetic characters
-        str = re.sub( preg_nonalpha, "", str)       # replace any non-alphanumeric characters with a space
-        
-        # if we've chosen to replace specific words in the string
-        if( options["replacewords"] ):
-            # for each word, remove it from end, beginning or middle as specified
-            for w in options["words"]:
-                if( isinstance(w, basestring) ):
-                    w = {"type":"middle", "name":w}
-                if( w["type"]=="end" ):
-                    if( str.endswith( w["name"] ) ):
-                        str = str[:-len( w["name"] )]
-                elif( w["type"]=="middle" ):
-                    str = str.replace( w["name"]," ")
-                else:
-                    if( str.startswith( w["name"] ) ):
-                        str = str[len( w["name"] ):]
-        
-        str = str.strip()                           # trim to remove any trailing spaces left over from the word removal
-        str = re.sub( r'\s+', " ", str)             # remove any double spaces
-        
-        # if we're reordering the string
-        if( options["reorder"] ):
-            str_array = str.split()                 # create an array with all the words in the string in it
-            str_array = sorted(str_array)           # sort the array alphabetically
-            str = string.join(str_array)            # put the words back together again
-        
-        # remove all spaces from the string
-        if( options["remspaces"]):
-            str = str.replace( " ","")
-        
-        return str                                  # return the normalised string
-        
+        if options:
+            return ReconcileNormaliser(options).normalise(str)
+        return self.normaliser.normalise(str)
         
 
 class ReconcileHit:
@@ -0,0 +1,419 @@
+from reconcileStorageDict import *
+
+import itertools
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+
+class ReconcileStorageSQLite( ReconcileStorageDict ):
+    """ Storage which keeps the rows in a SQLite database, with an FTS5 trigram index of
+        the normalised names
+
+    Nothing but the details of the database is held in memory, so it suits sources too
+    big to hold as dicts. If `database` is given the database is kept there and reused
+    next time - if the `fingerprint` (like the CSV file's size and modification time) and
+    options are unchanged the source isn't read at all. Otherwise the database is built
+    in a temporary file which is removed when the storage is closed. `previous` (the
+    storage being reloaded) isn't used - unlike the other storages, a changed source
+    means the whole database is built again.
+
+    Names are matched by the three-letter sequences they share with the query, ranked by
+    FTS5's bm25. The candidates are the names containing the rarest of the query's
+    trigrams, looked up until there are more than `max_candidates` of them, and these
+    trigrams count twice in the bm25 of the candidates. Trigrams in more than
+    `common_trigrams` of the names are left out, like stopwords. The score is the bm25 of a name as a proportion of the bm25 the query
+    itself would get, so it runs from 0 to 100 - only names which normalise to the same
+    as the query score 100. Queries shorter than three letters can't be matched with
+    trigrams, so the names containing them are found with LIKE instead. Properties of
+    queries aren't used.
+
+    Each thread (and each forked process) gets its own connection to the database.
+    """
+
+    # bm25 parameters used by FTS5
+    k1 = 1.2
+    b = 0.75
+    # bytes of the database file read with mmap by each connection
+    mmap_size = 256 * 1024 * 1024
+    # rows inserted at a time while building the database
+    chunk_size = 1000
+    # most names ranked for a query
+    max_candidates = 2000
+    # trigrams in more than this proportion of names aren't used to rank them
+    common_trigrams = 0.05
+
+    def __init__(self, source, search_field, id_field, database=None, fingerprint=None, normalise_options=None, previous=None):
+
+        # the field the will be searched by default
+        self.search_field = search_field
+        # the field that will be used to index
+        self.id_field = id_field
+        # turns names into the keys of the database
+        self.normaliser = ReconcileNormaliser(normalise_options)
+
+        # whether the database is thrown away when the storage is closed
+        self.temporary = database is None
+        if database is None:
+            fd, database = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+            os.remove(database)
+        self.database = database
+
+        # connections to the database, for each thread
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        # options read back from the database come from JSON, so compare them as JSON
+        normalise_options = json.loads( json.dumps(normalise_options) )
+        meta = self.read_meta()
+        if( meta is None or
+            meta["id_field"] != id_field or
+            meta["search_field"] != search_field or
+            meta["normalise_options"] != normalise_options or
+            (source is not None and (fingerprint is None or meta["fingerprint"] != fingerprint)) ):
+            self.create_database(source or [], fingerprint, normalise_options)
+            meta = self.read_meta()
+
+        self.fields = record_fields( f.encode("utf-8") if isinstance(f, unicode) else f for f in meta["fields"] )
+        # the columns of the rows table, for SELECTing whole rows
+        self.column_sql = ", ".join( "c%d" % n for n in range(len(self.fields)) )
+        self.id_column = "c%d" % self.fields[id_field] if id_field in self.fields else None
+        self.rows_count = meta["rows"]
+        self.keys_count = meta["keys"]
+        self.average_length = meta["average_length"]
+
+    def connection(self):
+        """ Return the database connection for this thread, opening it if needed. A
+            process forked from this one opens its own connections
+        """
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            conn = sqlite3.connect(self.database, check_same_thread=False)
+            conn.text_factory = str
+            conn.execute("PRAGMA query_only = 1")
+            conn.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+            self.local.connection = conn
+            self.local.pid = pid
+            with self.connections_lock:
+                self.connections.append( (pid, conn) )
+        return self.local.connection
+
+    def after_fork(self):
+        """ Replace the storage's locks in a process forked from this one
+        """
+        ReconcileStorageDict.after_fork(self)
+        self.connections_lock = threading.Lock()
+
+    def read_meta(self):
+        """ Return the details stored in the database, or None if there isn't a database
+        """
+        if not os.path.exists(self.database):
+            return None
+        conn = sqlite3.connect(self.database)
+        try:
+            return dict( (name, json.loads(value)) for name, value in conn.execute("SELECT name, value FROM meta") )
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            conn.close()
+
+    def create_database(self, source, fingerprint, normalise_options):
+        """ Build the database from the source. It's written to a temporary file which
+            then replaces the database, so storages which still have the old database
+            open can carry on using it
+        """
+        temp_database = "%s.%s.tmp" % (self.database, os.getpid())
+        if os.path.exists(temp_database):
+            os.remove(temp_database)
+        conn = sqlite3.connect(temp_database)
+        conn.text_factory = str
+        try:
+            # the file is only used once it's complete, so it doesn't need a journal
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+
+            source = iter(source)
+            first = next(source, None)
+            fields = list(first) if first is not None else []
+            if first is not None and self.id_field not in fields:
+                raise ValueError("The id field '%s' isn't in the source" % self.id_field)
+            columns = "".join( ", c%d" % n for n in range(len(fields)) )
+            conn.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE keys (keyid INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)")
+            conn.execute("CREATE TABLE rows (rowid INTEGER PRIMARY KEY, keyid INTEGER NOT NULL%s)" % columns)
+
+            # add the rows, giving each distinct key a number as it's found
+            insert_row = "INSERT INTO rows VALUES (NULL, ?%s)" % (", ?" * len(fields))
+            keyids = {}
+            rows = 0
+            chunk = []
+            for i in itertools.chain([first] if first is not None else [], source):
+                key = self.normaliser.normalise(i[self.search_field])
+                keyid = keyids.get(key)
+                if keyid is None:
+                    keyid = keyids[key] = len(keyids) + 1
+                    conn.execute("INSERT INTO keys VALUES (?, ?)", (keyid, key))
+                chunk.append( [keyid] + [ i[f] for f in fields ] )
+                rows += 1
+                if len(chunk) >= self.chunk_size:
+                    conn.executemany(insert_row, chunk)
+                    chunk = []
+            conn.executemany(insert_row, chunk)
+            keyids = None
+
+            # index the rows, and the trigrams of the keys
+            conn.execute("CREATE INDEX rows_keyid ON rows (keyid)")
+            if fields:
+                conn.execute("CREATE INDEX rows_id ON rows (c%d)" % fields.index(self.id_field))
+            conn.execute("CREATE VIRTUAL TABLE names USING fts5(key, content='keys', content_rowid='keyid', tokenize='trigram')")
+            conn.execute("INSERT INTO names (names) VALUES ('rebuild')")
+
+            # the number of names containing each trigram, which fts5vocab can't look up quickly
+            conn.execute("CREATE TABLE trigrams (trigram TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE VIRTUAL TABLE names_vocab USING fts5vocab(names, row)")
+            conn.execute("INSERT INTO trigrams SELECT term, doc FROM names_vocab")
+            conn.execute("DROP TABLE names_vocab")
+
+            key_count, length = conn.execute("SELECT count(*), sum(max(length(key) - 2, 0)) FROM keys").fetchone()
+            meta = {
+                "id_field": self.id_field,
+                "search_field": self.search_field,
+                "normalise_options": normalise_options,
+                "fingerprint": fingerprint,
+                "fields": fields,
+                "rows": rows,
+                "keys": key_count,
+                "average_length": float(length or 0) / key_count if key_count else 0.0,
+            }
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [ (k, json.dumps(v)) for k, v in meta.items() ])
+            conn.commit()
+            conn.close()
+        except:
+            conn.close()
+            os.remove(temp_database)
+            raise
+        os.rename(temp_database, self.database)
+
+    def record(self, values):
+        return ReconcileRecord(self.fields, values)
+
+    def key_rows(self, keyid, limit=None):
+        """ Return the rows with a key (given by its id)
+        """
+        sql = "SELECT %s FROM rows WHERE keyid = ? ORDER BY rowid" % self.column_sql
+        if limit:
+            sql += " LIMIT %d" % limit
+        return [ self.record(values) for values in self.connection().execute(sql, (keyid,)) ]
+
+    def trigrams(self, key):
+        """ Return a dict of the trigrams of a key => the number of times they appear
+        """
+        trigrams = {}
+        for x in range(len(key) - 2):
+            trigrams[key[x:x+3]] = trigrams.get(key[x:x+3], 0) + 1
+        return trigrams
+
+    def trigram_docs(self, trigrams):
+        """ Return a dict of trigram => the number of names containing it
+        """
+        placeholders = ", ".join( "?" * len(trigrams) )
+        return dict( self.connection().execute("SELECT trigram, docs FROM trigrams WHERE trigram IN (%s)" % placeholders, list(trigrams)) )
+
+    def best_bm25(self, phrases, trigrams, length, docs):
+        """ The bm25 score a name the same as the query would get for an FTS5 query of
+            `phrases` (trigrams, which can be repeated) - the highest score a name can
+            get for the query (as long as it doesn't repeat its trigrams)
+        """
+        average_length = self.average_length or 1.0
+        score = 0.0
+        for t in phrases:
+            count = trigrams[t]
+            n = docs.get(t, 0)
+            idf = math.log( (self.keys_count - n + 0.5) / (n + 0.5) )
+            if idf <= 0:
+                idf = 1e-6
+            score += idf * ( count * (self.k1 + 1) ) / ( count + self.k1 * (1 - self.b + self.b * length / average_length) )
+        return score
+
+    def top_keys(self, query_string, limit):
+        """ Return the best keys for a query as a list of (score, keyid) tuples, not
+            including the key which is the same as the query
+        """
+        conn = self.connection()
+
+        # trigrams can't be used for short queries, so look for names containing them
+        if len(query_string) < 3:
+            pattern = "%" + query_string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            sql = "SELECT keyid, key FROM keys WHERE key LIKE ? ESCAPE '\\' AND key != ? ORDER BY length(key), key"
+            if limit:
+                sql += " LIMIT %d" % limit
+            return [ (100.0 * len(query_string) / len(key), keyid) for keyid, key in conn.execute(sql, (pattern, query_string)) ]
+
+        trigrams = self.trigrams(query_string)
+        docs = self.trigram_docs(trigrams)
+
+        # the candidates contain the rarest trigrams (always including the rarest one)
+        rare = []
+        candidates = 0
+        for t in sorted(docs, key=docs.get):
+            if rare and candidates + docs[t] > self.max_candidates:
+                break
+            rare.append(t)
+            candidates += docs[t]
+        if not rare:
+            return []
+
+        # rank the candidates by bm25 for the query's trigrams, apart from those which are
+        # too common to say much about a name. FTS5 scores each phrase of the query, so
+        # the rare trigrams are counted twice
+        common = self.common_trigrams * self.keys_count
+        others = [ t for t in trigrams if t not in rare and docs.get(t, 0) <= common ]
+        match = "(%s)" % self.match_any(rare)
+        phrases = rare
+        if others:
+            match += " AND (%s)" % self.match_any(rare + others)
+            phrases = rare + rare + others
+        best = self.best_bm25(phrases, trigrams, len(query_string) - 2, docs)
+
+        sql = "SELECT rowid, key, bm25(names) FROM names WHERE names MATCH ? ORDER BY rank"
+        if limit:
+            # one more, in case the query's own key is one of them
+            sql += " LIMIT %d" % (limit + 1)
+        top = []
+        for keyid, key, rank in conn.execute(sql, (match,)):
+            if key == query_string:
+                continue
+            top.append( (min(100.0 * -rank / best, 99.99), keyid) )
+        if limit:
+            return top[0:limit]
+        return top
+
+    def match_any(self, trigrams):
+        """ Return an FTS5 query matching names containing any of the trigrams
+        """
+        return " OR ".join( '"%s"' % t.replace('"', '""') for t in trigrams )
+
+    def search(self, q):
+        """ Search for a query. The rows which have the same normalised name as the
+            query score 100, followed by the rows with the most similar names
+        """
+        with metrics.timer("stage_seconds", stage="normalise"):
+            query_string = self.normaliser.normalise_query(q.query)
+
+        results = []
+
+        # check for exact matches
+        exact = self.connection().execute("SELECT keyid FROM keys WHERE key = ?", (query_string,)).fetchone()
+        if exact is not None:
+            for i in self.key_rows(exact[0], q.limit):
+                results.append( ReconcileHit( i, 100 ) )
+
+        limit = q.limit and q.limit - len(results)
+        if limit is None or limit > 0:
+            with metrics.timer("stage_seconds", stage="candidates"):
+                top = self.top_keys(query_string, limit)
+            metrics.observe("candidates", len(top))
+            for score, keyid in top:
+                if q.limit and len(results) >= q.limit:
+                    break
+                for i in self.key_rows(keyid, q.limit and q.limit - len(results)):
+                    results.append( ReconcileHit( i, score ) )
+        return results
+
+    def search_many(self, qs):
+        return [ self.search(q) for q in qs ]
+
+    def prefix_search(self, prefix, limit=10):
+        """ Return hits for rows whose normalised name starts with a prefix. Shorter
+            names get a higher score, as more of the name has been typed. The shortest 
+            names are picked from the first `prefix_candidates` * `limit` names starting 
+            with the prefix, in alphabetical order
+        """
+        prefix = self.normaliser.normalise(prefix, partial=True)
+        sql = "SELECT keyid, key FROM keys WHERE key >= ? AND key < ? ORDER BY key LIMIT ?"
+        keys = self.connection().execute(sql, (prefix, prefix + "\xff", limit * self.prefix_candidates if limit else -1)).fetchall()
+
+        # stable sort, so names of the same length stay in alphabetical order
+        keys.sort(key=lambda k: len(k[1]))
+        results = []
+        for keyid, key in keys:
+            score = 100.0 * len(prefix) / len(key) if key else 100.0
+            for i in self.key_rows(keyid, limit and limit - len(results)):
+                results.append( ReconcileHit( i, score ) )
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def all(self, offset=0, limit=None):
+        """ return an iterator over the rows, starting at row `offset` and returning up
+            to `limit` rows. The rows are read a page at a time
+        """
+        conn = self.connection()
+        sql = "SELECT rowid, %s FROM rows WHERE rowid > ? ORDER BY rowid LIMIT ?" % self.column_sql
+
+        # find the row before the first one to return, then page through the rows after it
+        last = 0
+        if offset:
+            before = conn.execute("SELECT rowid FROM rows ORDER BY rowid LIMIT 1 OFFSET ?", (offset - 1,)).fetchone()
+            if before is None:
+                return
+            last = before[0]
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page = min(self.chunk_size, remaining) if remaining is not None else self.chunk_size
+            rows = conn.execute(sql, (last, page)).fetchall()
+            for values in rows:
+                yield self.record(values[1:])
+            if len(rows) < page:
+                break
+            last = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def count(self):
+        """ return the number of rows
+        """
+        return self.rows_count
+
+    def get_by_id(self, id):
+        """ return the record with a particular id, or None if there isn't one. Like
+            the dict storage, if more than one row has the id the last one is returned
+        """
+        if self.id_column is None:
+            return None
+        sql = "SELECT %s FROM rows WHERE %s = ? ORDER BY rowid DESC LIMIT 1" % (self.column_sql, self.id_column)
+        values = self.connection().execute(sql, (id,)).fetchone()
+        if values is None:
+            return None
+        return self.record(values)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type="", exc_value="", traceback=""):
+        pid = os.getpid()
+        with self.connections_lock:
+            connections = self.connections
+            self.connections = []
+        for conn_pid, conn in connections:
+            if conn_pid == pid:
+                conn.close()
+        self.local = threading.local()
+        if self.temporary and os.path.exists(self.database):
+            os.remove(self.database)
+
+    def close(self):
+        self.__exit__()
+
+    def __getattr__(self, name):
+        if not name.startswith("__") and "local" in self.__dict__:
+            result = self.get_by_id(name)
+            if result is not None:
+                return result
+
+        raise AttributeError("ReconcileStorageSQLite instance has no attribute '%s'" % name)
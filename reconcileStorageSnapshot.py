@@ -0,0 +1,300 @@
+from reconcileStorageDict import *
+from reconcileSnapshot import *
+
+import array
+import json
+
+# stored in place of a missing value (from a short row) - CSV files can't contain it
+MISSING = "\0"
+
+def snapshot_value(v):
+    """ Turn a value into the byte string stored in a snapshot
+    """
+    if v is None:
+        return MISSING
+    if isinstance(v, unicode):
+        return v.encode("utf-8")
+    if not isinstance(v, str):
+        return str(v)
+    return v
+
+def write_snapshot(storage, filename, **meta):
+    """ Write the rows and indexes of a ReconcileStorageDict to a snapshot file
+
+    The sections of the snapshot are:
+
+    - values: every value of every row, row by row
+    - keys: the sorted normalised names
+    - key_rows: the row ids for each key
+    - row_keys: the key (its position in `keys`) of each row
+    - grams: the sorted n-grams
+    - gram_keys: the keys containing each n-gram
+    - tokens: the sorted words of the keys
+    - token_keys: the keys containing each word
+    - ids, id_rows: the sorted ids, and the row with each id
+    """
+    writer = ReconcileSnapshotWriter(filename)
+    try:
+        fields = list(storage.rows[0]) if storage.rows else []
+        writer.write_table("values", ( snapshot_value(row.get(f)) for row in storage.rows for f in fields ))
+
+        keys = sorted(storage.docs)
+        key_numbers = dict( (k, n) for n, k in enumerate(keys) )
+        writer.write_table("keys", keys)
+        writer.write_postings("key_rows", ( storage.docs[k] for k in keys ))
+        writer.write_array("row_keys", array.array("i", ( key_numbers[k] for k in storage.row_keys )))
+
+        grams = sorted(storage.ngrams)
+        writer.write_table("grams", grams)
+        writer.write_postings("gram_keys", ( sorted( key_numbers[k] for k in storage.ngrams[g] ) for g in grams ))
+
+        tokens = sorted(storage.tokens)
+        writer.write_table("tokens", tokens)
+        writer.write_postings("token_keys", ( sorted( key_numbers[k] for k in storage.tokens[t] ) for t in tokens ))
+
+        # like the dict storage, the last row with an id is the one returned for it
+        id_rows = {}
+        for n, row in enumerate(storage.rows):
+            id_rows[ snapshot_value(row[storage.id_field]) ] = n
+        ids = sorted(id_rows)
+        writer.write_table("ids", ids)
+        writer.write_array("id_rows", array.array("i", ( id_rows[i] for i in ids )))
+    except:
+        writer.abort()
+        raise
+
+    meta["fields"] = fields
+    meta["rows"] = len(storage.rows)
+    writer.close(meta)
+
+class ReconcileStorageSnapshot( ReconcileStorageDict ):
+    """ Storage which keeps the data and indexes of the dict storage in a compact snapshot
+        file, which is read with mmap
+
+    Rather than holding every row and index in memory, only the parts of the file that
+    are needed are read, and the pages of the file are shared with every other process
+    reading it - like worker processes, or several copies of the service. Opening an
+    existing snapshot is almost instant.
+
+    The snapshot is rebuilt from the source if it doesn't exist, or if its `fingerprint`
+    (like the CSV file's size and modification time) or options have changed. If the
+    fingerprint isn't known and there is no source the existing snapshot is used.
+    """
+
+    def __init__(self, source, search_field, id_field, snapshot_file=None, fingerprint=None, normalise_options=None, scorer="difflib", property_fields=None, previous=None):
+        if snapshot_file is None:
+            raise ValueError("A snapshot file is needed for the snapshot storage")
+
+        # options read back from the snapshot come from JSON, so compare them as JSON
+        normalise_options = json.loads( json.dumps(normalise_options) )
+        
+        # the details are checked in the snapshot that is then used, so another process 
+        # replacing the file can't swap it for one which hasn't been checked
+        try:
+            self.snapshot = ReconcileSnapshot(snapshot_file)
+        except ReconcileSnapshotError:
+            self.snapshot = None
+        meta = self.snapshot.meta if self.snapshot is not None else None
+        if( meta is None or
+            meta.get("id_field") != id_field or
+            meta.get("search_field") != search_field or
+            meta.get("normalise_options") != normalise_options or
+            "tokens" not in meta["sections"] or
+            (source is not None and (fingerprint is None or meta.get("fingerprint") != fingerprint)) ):
+            if self.snapshot is not None:
+                self.snapshot.close()
+            self.create_snapshot(source or [], snapshot_file, search_field, id_field, fingerprint, normalise_options, previous)
+            self.snapshot = ReconcileSnapshot(snapshot_file)
+
+        # the field the will be searched by default
+        self.search_field = search_field
+        # the field that will be used to index
+        self.id_field = id_field
+        # turns names into the keys of the dict
+        self.normaliser = ReconcileNormaliser(normalise_options)
+
+        # the same attributes as the dict storage, but read from the snapshot
+        fields = record_fields( f.encode("utf-8") for f in self.snapshot.meta["fields"] )
+        keys = self.snapshot.table("keys")
+        self.rows = ReconcileSnapshotRows(self.snapshot.table("values"), fields)
+        self.row_keys = ReconcileSnapshotRowKeys(keys, self.snapshot.array("row_keys"))
+        self.docs = ReconcileSnapshotDocs(keys, self.snapshot.postings("key_rows"))
+        self.ngrams = ReconcileSnapshotIndex(self.snapshot.table("grams"), self.snapshot.postings("gram_keys"), keys)
+        self.tokens = ReconcileSnapshotIndex(self.snapshot.table("tokens"), self.snapshot.postings("token_keys"), keys)
+        self.sorted_keys = keys
+        self.ids = ReconcileSnapshotIds(self.snapshot.table("ids"), self.snapshot.array("id_rows"), self.rows)
+        self.scorer = SCORERS[scorer](self.docs)
+
+        # indexes of field => normalised value => array of row ids, which are held in memory
+        self.columns = {}
+        for field in property_fields or []:
+            self.index_column(field)
+
+    def create_snapshot(self, source, snapshot_file, search_field, id_field, fingerprint, normalise_options, previous):
+        """ Index the source with the dict storage, and write it to the snapshot file
+        """
+        storage = ReconcileStorageDict(source, search_field, id_field, normalise_options, previous=previous)
+        try:
+            write_snapshot(storage, snapshot_file,
+                id_field = id_field,
+                search_field = search_field,
+                normalise_options = normalise_options,
+                fingerprint = fingerprint,
+                )
+        finally:
+            storage.close()
+
+    def __exit__(self, exc_type="", exc_value="", traceback=""):
+        ReconcileStorageDict.__exit__(self)
+        self.snapshot.close()
+
+class ReconcileSnapshotRows(object):
+    """ The rows of a snapshot, as a read-only list of ReconcileRecords
+    """
+
+    def __init__(self, values, fields):
+        self.values = values
+        self.fields = fields
+        self.width = len(fields)
+
+    def __len__(self):
+        if not self.width:
+            return 0
+        return len(self.values) // self.width
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("row index out of range")
+        return self.record( self.values.slice(n * self.width, (n + 1) * self.width) )
+
+    def __iter__(self):
+        for start in xrange(0, len(self), 1000):
+            values = self.values.slice(start * self.width, min(len(self), start + 1000) * self.width)
+            for n in xrange(0, len(values), self.width):
+                yield self.record( values[n:n + self.width] )
+
+    def record(self, values):
+        return ReconcileRecord(self.fields, [ None if v == MISSING else v for v in values ])
+
+class ReconcileSnapshotRowKeys(object):
+    """ The normalised name of each row, as a read-only list
+    """
+
+    def __init__(self, keys, row_keys):
+        self.keys = keys
+        self.row_keys = row_keys
+
+    def __len__(self):
+        return len(self.row_keys)
+
+    def __getitem__(self, n):
+        return self.keys[ self.row_keys[n] ]
+
+    def __iter__(self):
+        for k in self.row_keys:
+            yield self.keys[k]
+
+class ReconcileSnapshotDocs(object):
+    """ The dict of normalised name => array of row ids
+    """
+
+    def __init__(self, keys, key_rows):
+        self.keys = keys
+        self.key_rows = key_rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.keys.find(key) >= 0
+
+    def __getitem__(self, key):
+        n = self.keys.find(key)
+        if n < 0:
+            raise KeyError(key)
+        return self.key_rows[n]
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def get(self, key, default=None):
+        n = self.keys.find(key)
+        if n < 0:
+            return default
+        return self.key_rows[n]
+
+class ReconcileSnapshotKeys(object):
+    """ The keys containing an n-gram or word. Its length is known without reading the keys
+    """
+
+    def __init__(self, keys, gram_keys, n):
+        self.keys = keys
+        self.gram_keys = gram_keys
+        self.n = n
+
+    def __len__(self):
+        return self.gram_keys.length(self.n)
+
+    def __iter__(self):
+        keys = self.keys
+        return ( keys[k] for k in self.gram_keys[self.n] )
+
+class ReconcileSnapshotIndex(object):
+    """ An inverted index of term (n-gram or word) => keys containing that term
+    """
+
+    def __init__(self, terms, term_keys, keys):
+        self.terms = terms
+        self.term_keys = term_keys
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return self.terms.find(term) >= 0
+
+    def __getitem__(self, term):
+        n = self.terms.find(term)
+        if n < 0:
+            raise KeyError(term)
+        return ReconcileSnapshotKeys(self.keys, self.term_keys, n)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def get(self, term, default=None):
+        n = self.terms.find(term)
+        if n < 0:
+            return default
+        return ReconcileSnapshotKeys(self.keys, self.term_keys, n)
+
+    def iteritems(self):
+        for n, term in enumerate(self.terms):
+            yield term, ReconcileSnapshotKeys(self.keys, self.term_keys, n)
+
+class ReconcileSnapshotIds(object):
+    """ The index of id => record
+    """
+
+    def __init__(self, ids, id_rows, rows):
+        self.ids = ids
+        self.id_rows = id_rows
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return self.ids.find( snapshot_value(id) ) >= 0
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def get(self, id, default=None):
+        n = self.ids.find( snapshot_value(id) )
+        if n < 0:
+            return default
+        return self.rows[ self.id_rows[n] ]
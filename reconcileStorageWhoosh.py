@@ -4,49 +4,242 @@ import whoosh.qparser
 
 from reconcileStorageDict import *
 
+import cPickle
+import hashlib
+import itertools
+import json
+import os
 import shutil
 import tempfile
             
 class ReconcileStorageWhoosh( ReconcileStorageDict ):
     """ Storage/retrieval engine using the Whoosh library
+    
+    By default the index is built in a temporary directory which is removed when the 
+    storage is closed. If `index_dir` is given the index is kept there instead and 
+    reused next time - if `fingerprint` (something identifying the version of the source, 
+    like the CSV file's size and modification time) is unchanged then the source isn't 
+    read at all, otherwise only rows which have been added, changed or removed since the 
+    index was built are updated.
+    
+    When the source is reloaded the `previous` version of the storage's index is 
+    updated in the same way, rather than building a new one. The previous storage can 
+    carry on searching its version of the index until it is closed.
+    
+    `procs`, `limitmb` and `multisegment` are passed to whoosh's writer: with `procs` 
+    above 1 the documents are indexed by several processes, `limitmb` is the memory 
+    each one uses to sort postings before writing them out, and `multisegment` skips 
+    merging the processes' segments at the end (faster to build, slower to search).
+    
+    With `store_keys` the normalised name of each document is also indexed as a single
+    term. Documents whose name normalises to the same key as a query (without 
+    properties) are found with a single lookup, and score 100 like an exact match in the
+    dict storage - if there are enough of them the full-text search is skipped.
+    
+    Documents are updated by their id, so each row of the source needs a different id -
+    a ValueError is raised if an id is found more than once.
     """
+    
+    # files in the index directory holding details of how the index was built
+    meta_file = "reconcile.json"
+    digests_file = "rows.pickle"
+    # field holding the normalised names, when `store_keys` is set
+    key_field = "reconcile_key"
 
-    def __init__(self, source, search_field, id_field):
+    def __init__(self, source, search_field, id_field, index_dir=None, fingerprint=None, previous=None, procs=1, limitmb=128, multisegment=False, store_keys=False):
     
-        # the temporary directory the index will be located in
-        self.index_dir = tempfile.mkdtemp()
+        # carry on using the previous version's index
+        if previous is not None and index_dir is None:
+            index_dir = previous.index_dir
+            self.temporary = previous.temporary
+        else:
+            # whether the index is thrown away when the storage is closed
+            self.temporary = index_dir is None
+        if index_dir is None:
+            index_dir = tempfile.mkdtemp()
+        elif not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+            
+        # the directory the index will be located in
+        self.index_dir = index_dir
         # the field the will be searched by default
         self.search_field = search_field
         # the field that will be used to index
         self.id_field = id_field
+        # used to normalise names
+        self.normaliser = ReconcileNormaliser()
+        # options for whoosh's writer
+        self.writer_options = {"procs": procs, "limitmb": limitmb}
+        if procs > 1:
+            self.writer_options["multisegment"] = multisegment
+        self.store_keys = store_keys
+        # query parsers for each field, which are reused between searches
+        self.parsers = {}
+        # the writer adding documents to the index, while it's being built
+        self.writer = None
         
-        # create a schema and index
-        schema = whoosh.fields.Schema()
-        self.ix = whoosh.index.create_in(self.index_dir, schema)
+        meta = self.read_meta()
+        try:
+            if( meta and meta["id_field"] == id_field and meta["requested_search_field"] == search_field and 
+                meta.get("store_keys", False) == store_keys ):
+                self.ix = whoosh.index.open_dir(self.index_dir)
+                self.search_field = meta["search_field"]
+                
+                # only look at the source if it has changed since the index was built
+                if fingerprint is None or meta["fingerprint"] != fingerprint:
+                    self.update_index(source)
+            else:
+                self.create_index(source)
+        except:
+            if self.writer is not None:
+                self.writer.cancel()
+                self.writer = None
+            if "ix" in self.__dict__:
+                self.ix.close()
+            if self.temporary and previous is None:
+                shutil.rmtree(self.index_dir)
+            raise
+        self.write_meta(fingerprint, search_field)
         
-        # populate the schema with fields from the first row of the source
-        self.writer = self.ix.writer()
-        for field in source[0]:
+        self.searcher = self.ix.searcher()
+        
+        # the index now belongs to this storage, so closing the previous one mustn't remove it
+        if previous is not None and previous.index_dir == self.index_dir:
+            previous.temporary = False
+        
+    def create_index(self, source):
+        """ Create a new index and add every row of the source to it
+        """
+        
+        source = iter(source)
+        first = next(source, None)
+        
+        # create a schema from the header of the source - records read from a CSV file 
+        # share the field names from its header row. The schema is complete before the 
+        # writer is created, so it can be handed to the writer's processes
+        schema = whoosh.fields.Schema()
+        for field in first or []:
             if( self.id_field == field ):
-                self.writer.add_field( field, whoosh.fields.ID(stored=True))
+                schema.add( field, whoosh.fields.ID(stored=True, unique=True))
             else:
-                self.writer.add_field( field, whoosh.fields.TEXT(stored=True))
+                schema.add( field, whoosh.fields.TEXT(stored=True))
                 
             if(self.search_field==None and field != self.id_field):
                 self.search_field = field
+        if first is not None and self.store_keys:
+            schema.add( self.key_field, whoosh.fields.ID())
+        self.ix = whoosh.index.create_in(self.index_dir, schema)
+        
+        if first is None:
+            self.write_digests({})
+            return
         
         # add documents to index
-        for i in source:
-            i2 = {}
-            for k,v in i.items():
-                if( isinstance(v, str)):
-                    i2[k] = unicode(v)
-                else:
-                    i2[k] = v
-            self.writer.add_document(**i2)
+        digests = {}
+        self.writer = self.ix.writer(**self.writer_options)
+        for i in itertools.chain([first], source):
+            items = i.items()
+            self.check_id(i[self.id_field], digests)
+            self.writer.add_document(**self.document(items))
+            digests[i[self.id_field]] = self.row_digest(items)
         self.writer.commit()
+        self.writer = None
+        self.write_digests(digests)
         
-        self.searcher = self.ix.searcher()
+    def update_index(self, source):
+        """ Bring an existing index up to date with the source, by comparing a digest of 
+            each row with the one stored when it was indexed
+        """
+        
+        source = iter(source)
+        first = next(source, None)
+        
+        # if the columns have changed the whole index needs rebuilding
+        fields = set(self.ix.schema.names())
+        fields.discard(self.key_field)
+        if first is None or set(first) != fields:
+            self.ix.close()
+            self.create_index(itertools.chain([first], source) if first is not None else [])
+            return
+        
+        old_digests = self.read_digests()
+        digests = {}
+        self.writer = self.ix.writer(**self.writer_options)
+        for i in itertools.chain([first], source):
+            id = i[self.id_field]
+            items = i.items()
+            self.check_id(id, digests)
+            digests[id] = self.row_digest(items)
+            if( id not in old_digests ):
+                self.writer.add_document(**self.document(items))
+            elif( old_digests[id] != digests[id] ):
+                self.writer.update_document(**self.document(items))
+        
+        # remove any rows that are no longer in the source
+        for id in old_digests:
+            if( id not in digests ):
+                self.writer.delete_by_term(self.id_field, self.to_unicode(id))
+        self.writer.commit()
+        self.writer = None
+        self.write_digests(digests)
+        
+    def check_id(self, id, digests):
+        """ Raise a ValueError if a row's id has already been indexed, as documents with
+            the same id would replace each other when the index is updated
+        """
+        if id in digests:
+            raise ValueError("The id '%s' is used by more than one row" % id)
+        
+    def document(self, items):
+        """ Turn the (field, value) items of a row of the source into the fields of a 
+            whoosh document
+        """
+        to_unicode = self.to_unicode
+        doc = dict( (k, to_unicode(v)) for k, v in items )
+        if self.store_keys and doc.get(self.search_field):
+            doc[self.key_field] = to_unicode( self.normaliser.normalise(doc[self.search_field]) )
+        return doc
+        
+    def to_unicode(self, v):
+        """ Values read from a CSV file are UTF-8 byte strings, but whoosh needs unicode
+        """
+        if( isinstance(v, str)):
+            return v.decode("utf-8", "replace")
+        return v
+        
+    def row_digest(self, items):
+        """ A digest of the (field, value) items of a row, used to spot rows that have 
+            changed
+        """
+        return hashlib.md5(repr(sorted(items))).digest()
+        
+    def read_meta(self):
+        path = os.path.join(self.index_dir, self.meta_file)
+        if not os.path.exists(path) or not whoosh.index.exists_in(self.index_dir):
+            return None
+        with open(path) as f:
+            return json.load(f)
+            
+    def write_meta(self, fingerprint, requested_search_field):
+        with open(os.path.join(self.index_dir, self.meta_file), 'w') as f:
+            json.dump({
+                "fingerprint": fingerprint,
+                "id_field": self.id_field,
+                "search_field": self.search_field,
+                "requested_search_field": requested_search_field,
+                "store_keys": self.store_keys,
+            }, f)
+            
+    def read_digests(self):
+        path = os.path.join(self.index_dir, self.digests_file)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+            
+    def write_digests(self, digests):
+        with open(os.path.join(self.index_dir, self.digests_file), 'wb') as f:
+            cPickle.dump(digests, f, cPickle.HIGHEST_PROTOCOL)
         
     def __enter__(self):
         return self
@@ -54,29 +247,117 @@ class ReconcileStorageWhoosh( ReconcileStorageDict ):
     def __exit__(self, exc_type="", exc_value="", traceback=""):
         self.searcher.close()
         self.ix.close()
-        shutil.rmtree(self.index_dir)
+        if self.temporary:
+            shutil.rmtree(self.index_dir)
         
     def close(self):
         self.__exit__()
     
+    def parser(self, field, termclass=whoosh.query.Term):
+        """ Return a query parser for a field. Parsers don't keep any state between 
+            queries, so each one is only created once
+        """
+        key = (field, termclass)
+        if key not in self.parsers:
+            self.parsers[key] = whoosh.qparser.QueryParser(field, self.ix.schema, termclass=termclass)
+        return self.parsers[key]
+        
     def search(self, q):
-        query = whoosh.qparser.QueryParser(self.search_field, self.ix.schema, termclass=whoosh.query.Variations).parse(q.query)
-        results = self.searcher.search(query)
-        return list(results)
+        """ Search for a query. If the query has properties which are fields of the index
+            then documents matching the name and all of the properties are returned, or 
+            if there aren't any, documents matching the name or any of the properties
+        """
+        properties = list(q.property_values())
+        exact = []
+        if not properties and self.key_field in self.ix.schema:
+            with metrics.timer("stage_seconds", stage="exact"):
+                key = self.to_unicode(self.normaliser.normalise(q.query))
+                exact = list(self.searcher.search(whoosh.query.Term(self.key_field, key), limit=q.limit))
+                for hit in exact:
+                    hit.score = 100
+                if q.limit and len(exact) >= q.limit:
+                    return exact
+        
+        with metrics.timer("stage_seconds", stage="parse"):
+            query = self.parser(self.search_field, whoosh.query.Variations).parse(self.to_unicode(q.query))
+            
+            field_queries = []
+            for field, values in properties:
+                if field not in self.ix.schema.names() or field == self.key_field:
+                    continue
+                parser = self.parser(field)
+                field_queries.append( whoosh.query.Or([ parser.parse(self.to_unicode(v)) for v in values ]) )
+        
+        with metrics.timer("stage_seconds", stage="search"):
+            if field_queries:
+                results = self.searcher.search(whoosh.query.And([query] + field_queries), limit=q.limit)
+                if len(results) > 0:
+                    return list(results)
+                query = whoosh.query.Or([query] + field_queries)
+            
+            results = self.searcher.search(query, limit=q.limit)
+            if not exact:
+                return list(results)
+            
+            # the exact matches come first, followed by the best of the other results
+            found = set( hit.docnum for hit in exact )
+            others = [ hit for hit in results if hit.docnum not in found ]
+            return exact + others[0:q.limit - len(exact) if q.limit else None]
+        
+    def prefix_search(self, prefix, limit=10):
+        """ Return hits for documents whose name contains words starting with the words 
+            of a prefix. The last word can be incomplete, unless the prefix ends in a space
+            
+        The prefix is split into words by the field's analyzer, so words it leaves out of
+        the index (like stopwords and punctuation) are left out of the search too. The 
+        last word is kept if it's incomplete, as it may be the start of another word
+        """
+        analyzer = self.ix.schema[self.search_field].analyzer
+        words = [ (t.text, t.stopped) for t in analyzer(self.to_unicode(prefix), removestops=False) ]
+        incomplete = bool(words) and not prefix[-1].isspace()
+        terms = [ whoosh.query.Term(self.search_field, w) for w, stopped in words[0:-1 if incomplete else None] if not stopped ]
+        if incomplete:
+            terms.append( whoosh.query.Prefix(self.search_field, words[-1][0]) )
+        if not terms:
+            return []
+        return list(self.searcher.search(whoosh.query.And(terms), limit=limit))
         
-    def all(self):
-        docs = self.searcher.documents()
-        data = []
-        for d in docs:
-            data.append(d)
-        return data
+    def search_many(self, qs):
+        return [ self.search(q) for q in qs ]
+        
+    def cache_key(self, query):
+        """ return a key for caching the results of a query - the parsed query, so 
+            queries differing only in the case of their words share a key, but operators
+            like AND and NOT (which are only operators in capitals) are kept apart
+        """
+        key = repr(self.parser(self.search_field, whoosh.query.Variations).parse(self.to_unicode(query)))
+        if self.key_field in self.ix.schema:
+            key = (key, self.normaliser.normalise(query))
+        return key
+        
+    def all(self, offset=0, limit=None):
+        """ return an iterator over the stored fields of the documents, starting at 
+            document `offset` and returning up to `limit` documents
+        """
+        stop = None if limit is None else offset + limit
+        reader = self.searcher.reader()
+        return ( reader.stored_fields(n) for n in itertools.islice(reader.all_doc_ids(), offset, stop) )
+        
+    def count(self):
+        """ return the number of documents
+        """
+        return self.searcher.doc_count()
+        
+    def get_by_id(self, id):
+        """ return the stored fields of the document with a particular id, or None if
+            there isn't one
+        """
+        return self.searcher.document(**{self.id_field: self.to_unicode(id)})
         
     def __getattr__(self, name):
-        parser = whoosh.qparser.QueryParser(self.id_field, self.ix.schema)
-        parser.add_plugin(whoosh.qparser.FuzzyTermPlugin())
-        query = parser.parse(name)
-        results = self.searcher.search(query)
-        if(len(results)>0):
-            return results[0].fields()
-        else:
-            raise AttributeError("ReconcileStorageWhoosh instance has no attribute '%s'" % name)
\ No newline at end of file
+        if not name.startswith("__") and "searcher" in self.__dict__:
+            result = self.get_by_id(name)
+            if result is not None:
+                return result
+        
+        raise AttributeError("ReconcileStorageWhoosh instance has no attribute '%s'" % name)
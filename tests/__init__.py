@@ -0,0 +1,4 @@
+""" Tests for the reconciliation service. Run them from the root of the repository with:
+
+    python -m unittest discover
+"""
@@ -0,0 +1,77 @@
+import os
+import threading
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class SlowEngine:
+    """ An engine whose batches don't finish until they are released
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def queries(self, queries):
+        self.release.wait()
+        return dict( (k, {"result": []}) for k in queries )
+
+class TestBatcher(unittest.TestCase):
+
+    def test_results_match_engine(self):
+        with ReconcileEngine(source=get_from_csv(EXAMPLE)) as r:
+            batcher = ReconcileBatcher(r, window=0.05)
+            queries = ["Hartlepool", "York", "Leeds", "nowhere", {"query": "Barnsley", "limit": 1}]
+            results = {}
+            def run(n, q):
+                results[n] = batcher.query(q)
+            threads = [ threading.Thread(target=run, args=(n, q)) for n, q in enumerate(queries) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            batcher.close()
+            for n, q in enumerate(queries):
+                self.assertEqual(results[n], r.query(q))
+
+    def test_bad_query_only_fails_itself(self):
+        with ReconcileEngine(source=get_from_csv(EXAMPLE)) as r:
+            batcher = ReconcileBatcher(r, window=0.05)
+            results = {}
+            def run(n, q):
+                try:
+                    results[n] = batcher.query(q)
+                except Exception as e:
+                    results[n] = e
+            threads = [ threading.Thread(target=run, args=(n, q)) for n, q in enumerate(["York", 123]) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            batcher.close()
+            self.assertEqual(results[0], r.query("York"))
+            self.assertIsInstance(results[1], Exception)
+
+    def test_timeout(self):
+        engine = SlowEngine()
+        batcher = ReconcileBatcher(engine, window=0, timeout=0.1)
+        try:
+            self.assertRaises(ReconcileBatchTimeout, batcher.query, "York")
+        finally:
+            engine.release.set()
+            batcher.close()
+
+class TestBatchWindowServer(unittest.TestCase):
+
+    def test_threaded_servers(self):
+        self.assertFalse(is_threaded_server("wsgiref"))
+        self.assertFalse(is_threaded_server("tornado"))
+        self.assertFalse(is_threaded_server("gunicorn"))
+        self.assertFalse(is_threaded_server("threaded", threads=1))
+        self.assertTrue(is_threaded_server("threaded"))
+        self.assertTrue(is_threaded_server("waitress", threads=4))
+        self.assertTrue(is_threaded_server("gunicorn", threads=4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestBulkReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.r = ReconcileEngine(source=get_from_csv(EXAMPLE), storage_options={"property_fields": ["old_code"]})
+
+    def tearDown(self):
+        self.r.__exit__(None, None, None)
+        shutil.rmtree(self.dir)
+
+    def bulk(self, text, **kwargs):
+        filename = os.path.join(self.dir, "input.csv")
+        with open(filename, "wb") as f:
+            f.write(text)
+        output = StringIO()
+        rows = bulk_reconcile(self.r, filename, output, **kwargs)
+        return rows, list(csv.reader(StringIO(output.getvalue())))
+
+    def test_matches_are_written(self):
+        rows, output = self.bulk("q,code\nHartlepool,00EB\nYork,\n", column="q", top=2)
+        self.assertEqual(rows, 2)
+        self.assertEqual(output[0], ["q", "code", "match_id", "match_name", "match_score", "match_exact", 
+            "match_id_2", "match_name_2", "match_score_2", "match_exact_2"])
+        self.assertEqual(output[1][0:6], ["Hartlepool", "00EB", "E06000001", "Hartlepool", "100.0", "true"])
+        self.assertEqual(output[2][2:4], ["E06000014", "York"])
+
+    def test_rows_line_up(self):
+        rows, output = self.bulk("q,code\nHartlepool,00EB\n\nYork\n", column="q")
+        self.assertEqual(rows, 3)
+        self.assertEqual(set(len(row) for row in output), set([6]))
+        self.assertEqual(output[2], [""] * 6)
+        self.assertEqual(output[3][0:4], ["York", "", "E06000014", "York"])
+
+    def test_properties(self):
+        rows, output = self.bulk("q,code\nHart,00EB\n", column="q", properties=[("code", "old_code")])
+        self.assertEqual(output[1][2], "E06000001")
+
+    def test_bulk_main_indexes_properties(self):
+        filename = os.path.join(self.dir, "input.csv")
+        with open(filename, "wb") as f:
+            f.write("q,code\nHart,00EB\n")
+        output = os.path.join(self.dir, "output.csv")
+        bulk_main([EXAMPLE, filename, "-c", "q", "--properties", "code:old_code", "-o", output, "--workers", "1", "--quiet"])
+        with open(output, "rb") as f:
+            self.assertEqual(list(csv.reader(f))[1][2], "E06000001")
+
+    def test_unknown_column(self):
+        self.assertRaises(ValueError, self.bulk, "q\nYork\n", column="name")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import time
+import unittest
+
+from reconcileCache import *
+
+class TestCache(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ReconcileCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual( (cache.get("a"), cache.get("c")), (1, 3) )
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats(), {"size": 2, "bytes": 0, "hits": 3, "misses": 1, "evictions": 1})
+
+    def test_replacing_an_item(self):
+        cache = ReconcileCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_ttl(self):
+        cache = ReconcileCache(ttl=0.05)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertEqual(cache.get("a", "expired"), "expired")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_max_bytes(self):
+        cache = ReconcileCache(max_bytes=10, sizeof=len)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        cache.set("c", "123")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+    def test_turned_off(self):
+        cache = ReconcileCache(max_size=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_clear(self):
+        cache = ReconcileCache()
+        cache.set("a", 1)
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
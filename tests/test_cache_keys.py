@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestCacheKeys(unittest.TestCase):
+
+    storage = None
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.r = ReconcileEngine(source=get_from_csv(EXAMPLE), storage=self.storage, storage_options=self.storage_options())
+
+    def tearDown(self):
+        self.r.__exit__(None, None, None)
+        shutil.rmtree(self.dir)
+
+    def storage_options(self):
+        return {}
+
+    def test_equivalent_queries_share_a_key(self):
+        keys = set( self.r.storage.cache_key(q) for q in ["County Durham", "county durham", "County  Durham!"] )
+        self.assertEqual(len(keys), 1)
+        self.assertNotEqual(self.r.storage.cache_key("County Durham"), self.r.storage.cache_key("Durham"))
+
+    def test_equivalent_queries_use_the_cache(self):
+        first = self.r.query("County Durham")
+        self.assertEqual(self.r.query("county durham!"), first)
+        self.assertEqual(self.r.cache_stats()["hits"], 1)
+
+        # a different limit isn't the same query
+        self.r.query({"query": "County Durham", "limit": 1})
+        self.assertEqual(self.r.cache_stats()["hits"], 1)
+
+class TestSnapshotCacheKeys(TestCacheKeys):
+    storage = ReconcileStorageSnapshot
+
+    def storage_options(self):
+        return {"snapshot_file": os.path.join(self.dir, "example.snapshot")}
+
+class TestSQLiteCacheKeys(TestCacheKeys):
+    storage = ReconcileStorageSQLite
+
+class TestWhooshCacheKeys(TestCacheKeys):
+    storage = ReconcileStorageWhoosh
+
+    def test_operators_are_kept_apart(self):
+        self.assertNotEqual(self.r.storage.cache_key("durham NOT county"), self.r.storage.cache_key("durham not county"))
+
+        self.assertEqual(self.r.query("durham NOT county")["result"], [])
+        self.assertEqual([ i["name"] for i in self.r.query("durham not county")["result"] ], ["County Durham"])
+
+if __name__ == '__main__':
+    unittest.main()
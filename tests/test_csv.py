@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestGetFromCsv(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_csv(self, text):
+        filename = os.path.join(self.dir, "data.csv")
+        with open(filename, "wb") as f:
+            f.write(text)
+        return filename
+
+    def test_blank_lines_are_skipped(self):
+        with open(EXAMPLE) as f:
+            lines = f.read().splitlines()
+        filename = self.write_csv("\n".join(lines[0:3] + [""] + lines[3:] + [""]) + "\n")
+
+        rows = list(get_from_csv(filename))
+        self.assertEqual(len(rows), len(lines) - 1)
+        self.assertTrue(all(r["name"] for r in rows))
+
+        with ReconcileEngine(source=get_from_csv(filename)) as r:
+            self.assertEqual(r.count(), len(lines) - 1)
+            self.assertEqual(r.query("Hartlepool")["result"][0]["id"], "E06000001")
+
+    def test_non_ascii(self):
+        filename = self.write_csv("id,name\n1,Café Nord\n2,Ynys Môn\n")
+        rows = list(get_from_csv(filename))
+        self.assertEqual([ r["name"] for r in rows ], ["Café Nord", "Ynys Môn"])
+
+        with ReconcileEngine(source=get_from_csv(filename)) as r:
+            self.assertEqual(r.query("Ynys Môn")["result"][0]["id"], "2")
+            self.assertEqual(r.query(u"Ynys Môn")["result"][0]["id"], "2")
+            self.assertEqual(r.get_by_id("1")["name"], "Café Nord")
+
+    def test_no_header_row(self):
+        filename = self.write_csv("1,Hartlepool\n\n2,York\n")
+        rows = list(get_from_csv(filename, header_row=False))
+        self.assertEqual([ r.to_dict() for r in rows ], [ {"0": "1", "1": "Hartlepool"}, {"0": "2", "1": "York"} ])
+
+if __name__ == '__main__':
+    unittest.main()
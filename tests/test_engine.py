@@ -0,0 +1,40 @@
+import os
+import threading
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestEnginePool(unittest.TestCase):
+
+    def test_pool_started_with_storage(self):
+        with ReconcileEngine(source=get_from_csv(EXAMPLE), workers=2, executor="process") as r:
+            pool = r.pool
+            self.assertIsNotNone(pool)
+            results = r.queries({"q0": "York", "q1": "Leeds", "q2": "Hartlepool"})
+            self.assertEqual(results["q1"]["result"][0]["name"], "Leeds")
+            self.assertIs(r.pool, pool)
+
+            # reloading starts a new pool for the new storage
+            r.load(get_from_csv(EXAMPLE))
+            self.assertIsNot(r.pool, pool)
+            self.assertIsNotNone(r.pool)
+
+    def test_no_pool_for_one_worker(self):
+        with ReconcileEngine(source=get_from_csv(EXAMPLE)) as r:
+            self.assertIsNone(r.pool)
+
+    def test_concurrent_get_pool(self):
+        with ReconcileEngine(source=get_from_csv(EXAMPLE), workers=2, executor="thread") as r:
+            r.close_pool()
+            pools = []
+            threads = [ threading.Thread(target=lambda: pools.append(r.get_pool())) for n in range(8) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(set(map(id, pools))), 1)
+
+if __name__ == '__main__':
+    unittest.main()
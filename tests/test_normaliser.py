@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from reconcileNormaliser import *
+
+class TestNormaliser(unittest.TestCase):
+
+    def test_default(self):
+        n = ReconcileNormaliser()
+        self.assertEqual(n.normalise("The  County Durham!"), "county durham")
+        self.assertEqual(n.normalise("Brighton & Hove"), "brighton and hove")
+        self.assertEqual(n.normalise(u"Ynys Môn"), "ynys mn")
+
+    def test_reorder(self):
+        n = ReconcileNormaliser({"reorder": True})
+        self.assertEqual(n.normalise("Durham County"), n.normalise("County Durham"))
+
+    def test_rembrackets(self):
+        self.assertEqual(ReconcileNormaliser({"rembrackets": True}).normalise("Hart (District)"), "hart")
+        self.assertEqual(ReconcileNormaliser().normalise("Hart (District)"), "hart district")
+
+    def test_stopwords(self):
+        n = ReconcileNormaliser({"stopwords": ReconcileNormaliser.default_stopwords})
+        self.assertEqual(n.normalise("Isle of Wight"), "isle wight")
+        self.assertEqual(n.normalise("Bath and North East Somerset"), "bath north east somerset")
+
+    def test_suffixes(self):
+        n = ReconcileNormaliser({"suffixes": ReconcileNormaliser.legal_suffixes})
+        self.assertEqual(n.normalise("Acme Widgets Ltd"), n.normalise("Acme Widgets Limited."))
+        self.assertEqual(n.normalise("Acme Widgets Co Ltd"), "acme widgets")
+        # there's always a word left
+        self.assertEqual(n.normalise("Limited"), "limited")
+        # prefixes which are still being typed keep their last word
+        self.assertEqual(n.normalise("Acme Co", partial=True), "acme co")
+
+    def test_values(self):
+        n = ReconcileNormaliser()
+        self.assertEqual(n.normalise_value("SW1A 1AA"), "sw1a1aa")
+        self.assertEqual(n.normalise_value(123), "123")
+
+    def test_query_cache(self):
+        n = ReconcileNormaliser()
+        self.assertEqual(n.normalise_query("County Durham"), "county durham")
+        self.assertEqual(n.normalise_query("County Durham"), "county durham")
+        self.assertEqual(n.cache.stats()["hits"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import json
+import os
+import unittest
+import urllib
+import wsgiref.util
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestProperties(unittest.TestCase):
+
+    def setUp(self):
+        self.r = ReconcileEngine(source=get_from_csv(EXAMPLE), storage_options={"property_fields": ["old_code"]})
+
+    def tearDown(self):
+        self.r.__exit__(None, None, None)
+
+    def test_configured_field(self):
+        result = self.r.query({"query": "Hart", "properties": [{"pid": "old_code", "v": "00EB"}]})
+        self.assertEqual(result["result"][0]["id"], "E06000001")
+
+    def test_other_fields_are_ignored(self):
+        q = {"query": "York", "properties": [{"pid": "id", "v": "E06000001"}]}
+        self.assertEqual(self.r.query(q), self.r.query("York"))
+        self.assertEqual(sorted(self.r.storage.columns), ["old_code"])
+
+    def test_malformed_properties(self):
+        for properties in ["old_code", [["old_code", "00EB"]], {"pid": "old_code", "v": "00EB"}]:
+            self.assertRaises(ValueError, self.r.query, {"query": "York", "properties": properties})
+        self.assertRaises(ValueError, self.r.query, 123)
+
+    def test_malformed_properties_are_a_bad_request(self):
+        app = create_app(self.r)
+        for params in [
+            {"query": json.dumps({"query": "York", "properties": "old_code"})},
+            {"queries": json.dumps({"q0": {"query": "York", "properties": "old_code"}})},
+        ]:
+            environ = {"QUERY_STRING": urllib.urlencode(params)}
+            wsgiref.util.setup_testing_defaults(environ)
+            status = []
+            app(environ, lambda s, headers, exc_info=None: status.append(s))
+            self.assertEqual(status[0][0:3], "400")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from reconcileScorer import *
+
+KEYS = ["hartlepool", "hart", "harrogate", "hartlepool borough", "north hart", "east hartford", "york", "ha"]
+
+@unittest.skipIf(numpy is None, "numpy isn't installed")
+class TestScorerNumpy(unittest.TestCase):
+
+    def setUp(self):
+        self.difflib = ReconcileScorer(KEYS)
+        self.numpy = ReconcileScorerNumpy(KEYS)
+
+    def test_same_as_difflib_for_keys_containing_the_query(self):
+        for query in ["hart", "hartlepool", "ha", "h"]:
+            keys = [ k for k in KEYS if query in k and k != query ]
+            expected = dict( (k, s) for s, k in self.difflib.top_scores(query, keys) )
+            for score, key in self.numpy.top_scores(query, keys):
+                self.assertAlmostEqual(score, expected[key], places=4, msg="%s %s" % (query, key))
+
+    def test_only_exact_matches_score_100(self):
+        scores = dict( (k, s) for s, k in self.numpy.top_scores("hart", KEYS) )
+        self.assertLess(scores["hart"], 100)
+        self.assertEqual(scores["york"], 0)
+
+    def test_limit(self):
+        self.assertEqual(self.numpy.top_scores("hart", KEYS, 2), self.numpy.top_scores("hart", KEYS)[0:2])
+
+    def test_batch_same_as_single(self):
+        queries = ["hart", "hartlepool", "york"]
+        keys = [ [ k for k in KEYS if q in k ] for q in queries ]
+        batch = self.numpy.top_scores_many(queries, keys, [3, None, 1])
+        single = [ self.numpy.top_scores(q, k, l) for q, k, l in zip(queries, keys, [3, None, 1]) ]
+        for b, s in zip(batch, single):
+            self.assertEqual([ k for score, k in b ], [ k for score, k in s ])
+            for (x, _), (y, _) in zip(b, s):
+                self.assertAlmostEqual(x, y, places=4)
+
+class TestScorer(unittest.TestCase):
+
+    def test_limit_keeps_the_best(self):
+        scorer = ReconcileScorer(KEYS)
+        everything = scorer.top_scores("hartlepool", KEYS)
+        self.assertEqual(scorer.top_scores("hartlepool", KEYS, 3), everything[0:3])
+        self.assertEqual(everything[0], (100.0, "hartlepool"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+from reconcileStorageSnapshot import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.dir, "example.snapshot")
+        self.fingerprint = csv_fingerprint(EXAMPLE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open_snapshot(self, source=True, fingerprint=None, normalise_options=None):
+        return ReconcileStorageSnapshot(get_from_csv(EXAMPLE) if source else None, "name", "id",
+            snapshot_file=self.snapshot_file, fingerprint=fingerprint or self.fingerprint,
+            normalise_options=normalise_options)
+
+    def test_round_trip(self):
+        storage = ReconcileStorageDict(get_from_csv(EXAMPLE), "name", "id")
+        snapshot = self.open_snapshot()
+        try:
+            self.assertEqual(snapshot.count(), storage.count())
+            self.assertEqual(list(snapshot.all(0, 50)), list(storage.all(0, 50)))
+            for row in storage.all(0, 50):
+                self.assertEqual(snapshot.get_by_id(row["id"]), storage.get_by_id(row["id"]))
+            self.assertEqual(list(snapshot.docs), sorted(storage.docs))
+            self.assertEqual(snapshot.snapshot.meta["fingerprint"], self.fingerprint)
+        finally:
+            snapshot.close()
+
+    def test_reused_when_unchanged(self):
+        self.open_snapshot().close()
+        built = os.stat(self.snapshot_file)
+
+        for source in (True, False):
+            snapshot = self.open_snapshot(source)
+            snapshot.close()
+            self.assertEqual(os.stat(self.snapshot_file).st_ino, built.st_ino)
+
+    def test_rebuilt_when_changed(self):
+        self.open_snapshot().close()
+
+        for options in ({"fingerprint": "changed"}, {"normalise_options": {"reorder": True}}):
+            built = os.stat(self.snapshot_file)
+            snapshot = self.open_snapshot(**options)
+            snapshot.close()
+            self.assertNotEqual(os.stat(self.snapshot_file).st_ino, built.st_ino)
+
+    def test_rebuilt_when_not_a_snapshot(self):
+        with open(self.snapshot_file, "wb") as f:
+            f.write("not a snapshot")
+        snapshot = self.open_snapshot()
+        try:
+            self.assertEqual(snapshot.get_by_id("E06000001")["name"], "Hartlepool")
+        finally:
+            snapshot.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+def text(v):
+    # the dict and sqlite storages return UTF-8, whoosh returns unicode
+    return v.decode("utf-8") if isinstance(v, str) else v
+
+class TestStoragesMatch(unittest.TestCase):
+    """ The same queries against example.csv give the same answers with each storage
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.rows = list(get_from_csv(EXAMPLE))
+        cls.engines = {
+            "dict": ReconcileEngine(source=get_from_csv(EXAMPLE)),
+            "snapshot": ReconcileEngine(source=get_from_csv(EXAMPLE), storage=ReconcileStorageSnapshot, 
+                storage_options={"snapshot_file": os.path.join(cls.dir, "example.snapshot")}),
+            "sqlite": ReconcileEngine(source=get_from_csv(EXAMPLE), storage=ReconcileStorageSQLite),
+            "whoosh": ReconcileEngine(source=get_from_csv(EXAMPLE), storage=ReconcileStorageWhoosh),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        for r in cls.engines.values():
+            r.__exit__(None, None, None)
+        shutil.rmtree(cls.dir)
+
+    def test_exact_names(self):
+        for name, r in self.engines.items():
+            for row in self.rows:
+                best = r.query(row["name"])["result"][0]
+                self.assertEqual( (text(best["id"]), best["match"]), (row["id"], True), "%s: %s" % (name, row["name"]) )
+
+    def test_records(self):
+        for name, r in self.engines.items():
+            self.assertEqual(r.count(), len(self.rows), name)
+            self.assertEqual(set( text(i["id"]) for i in r.all() ), set( i["id"] for i in self.rows ), name)
+            for row in self.rows[0:20]:
+                record = r.get_by_id(row["id"])
+                self.assertEqual(dict( (k, text(v)) for k, v in record.items() ), dict(row.items()), name)
+            self.assertIsNone(r.get_by_id("missing"), name)
+
+    def test_snapshot_matches_dict(self):
+        for q in [ row["name"] for row in self.rows[0:50] ] + ["hart", "north", "council borough", "york", "ab"]:
+            self.assertEqual(self.engines["snapshot"].query(q), self.engines["dict"].query(q), q)
+        self.assertEqual(self.engines["snapshot"].suggest({"prefix": "nor"}), self.engines["dict"].suggest({"prefix": "nor"}))
+
+if __name__ == '__main__':
+    unittest.main()
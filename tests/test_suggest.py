@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+
+class TestSuggest(unittest.TestCase):
+
+    storage = None
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        filename = os.path.join(self.dir, "data.csv")
+        with open(filename, "wb") as f:
+            f.write("id,name,note\n1,Café Nord,Crème brûlée\n2,Isle of Wight,\n3,St. Helens,\n4,Hart,\n5,Haringey,\n6,Harborough,\n")
+        self.r = ReconcileEngine(source=get_from_csv(filename), storage=self.storage)
+
+    def tearDown(self):
+        self.r.__exit__(None, None, None)
+        shutil.rmtree(self.dir)
+
+    def suggest(self, prefix, limit=None):
+        # the dict storage returns the names as UTF-8, whoosh as unicode
+        names = [ i["name"] for i in self.r.suggest({"prefix": prefix, "limit": limit})["result"] ]
+        return [ n.decode("utf-8") if isinstance(n, str) else n for n in names ]
+
+    def test_flyout_non_ascii(self):
+        html = self.r.flyout("1")["html"]
+        self.assertIn(u"<h3>Café Nord</h3>", html)
+        self.assertIn(u"Crème brûlée", html)
+
+    def test_query_non_ascii(self):
+        for q in ["Café Nord", u"Café Nord"]:
+            best = self.r.query(q)["result"][0]
+            self.assertEqual( (best["id"], best["match"]), ("1", True) )
+
+    def test_prefix_non_ascii(self):
+        self.assertEqual(self.suggest("caf"), [u"Café Nord"])
+
+    def test_prefix_with_stopwords_and_punctuation(self):
+        self.assertEqual(self.suggest("isle of w"), [u"Isle of Wight"])
+        self.assertEqual(self.suggest("st. hel"), [u"St. Helens"])
+
+    def test_shortest_names_first(self):
+        self.assertEqual(self.suggest("har", limit=2)[0], u"Hart")
+
+class TestSuggestWhoosh(TestSuggest):
+    storage = ReconcileStorageWhoosh
+
+    def test_shortest_names_first(self):
+        # whoosh ranks the names by its own scores
+        pass
+
+class TestSuggestSQLite(TestSuggest):
+    storage = ReconcileStorageSQLite
+
+if __name__ == '__main__':
+    unittest.main()
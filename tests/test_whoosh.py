@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reconcile import *
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.csv")
+
+class TestWhooshIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = list(get_from_csv(EXAMPLE))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def storage(self, rows, index_dir, fingerprint):
+        return ReconcileStorageWhoosh(rows, "name", "id", index_dir=index_dir, fingerprint=fingerprint)
+
+    def documents(self, storage):
+        return sorted( sorted(d.items()) for d in storage.searcher.documents() )
+
+    def test_update_matches_full_build(self):
+        changed = [ dict(i.items()) for i in self.rows[5:] ]
+        changed[0]["name"] = "Somewhere Else"
+        changed.append({"id": "NEW1", "old_code": "", "name": "Newtown"})
+
+        updated = self.storage(self.rows, os.path.join(self.dir, "updated"), "a")
+        updated.close()
+        updated = self.storage(changed, os.path.join(self.dir, "updated"), "b")
+        full = self.storage(changed, os.path.join(self.dir, "full"), "b")
+        try:
+            self.assertEqual(self.documents(updated), self.documents(full))
+            self.assertEqual(updated.count(), len(changed))
+        finally:
+            updated.close()
+            full.close()
+
+    def test_duplicate_ids_are_rejected(self):
+        duplicated = self.rows + [self.rows[0]]
+        self.assertRaises(ValueError, self.storage, duplicated, os.path.join(self.dir, "full"), "a")
+
+        index_dir = os.path.join(self.dir, "updated")
+        self.storage(self.rows, index_dir, "a").close()
+        self.assertRaises(ValueError, self.storage, duplicated, index_dir, "b")
+
+        # the index is left as it was
+        storage = self.storage(self.rows, index_dir, "a")
+        try:
+            self.assertEqual(storage.count(), len(self.rows))
+        finally:
+            storage.close()
+
+    def test_temporary_index_is_removed_on_error(self):
+        before = set(os.listdir(tempfile.gettempdir()))
+        self.assertRaises(ValueError, self.storage, self.rows + [self.rows[0]], None, None)
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())) - before, set())
+
+if __name__ == '__main__':
+    unittest.main()